@@ -1,17 +1,37 @@
 import asyncio
 import os
 import logging
+import time
+import heapq
+import random
+import hashlib
+import itertools
+import json
+import sqlite3
+from collections import deque, OrderedDict
+from dataclasses import dataclass
+from typing import Optional
 import aiosqlite
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from aiogram import Bot, Dispatcher, F, types
 from aiogram.filters import Command
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-from telethon import TelegramClient
-from telethon.errors import SessionPasswordNeededError, PhoneCodeInvalidError, PasswordHashInvalidError, AuthKeyDuplicatedError
+from telethon import TelegramClient, events, utils
+from telethon.extensions import markdown
+from telethon.crypto import AuthKey
+from telethon.sessions import MemorySession
+from telethon.tl.types import PeerUser, PeerChat, PeerChannel, UpdateChannel
+from telethon.tl.types.updates import State as UpdatesState
+from telethon.errors import SessionPasswordNeededError, PhoneCodeInvalidError, PasswordHashInvalidError, AuthKeyDuplicatedError, FloodWaitError, SlowModeWaitError, FileReferenceExpiredError, UnauthorizedError
+from telethon.errors import ChatWriteForbiddenError, ChannelPrivateError, UserBannedInChannelError, ChatAdminRequiredError, ChatRestrictedError, ChannelInvalidError, ChatIdInvalidError, PeerIdInvalidError, InputUserDeactivatedError, UserIsBlockedError
 from dotenv import load_dotenv
+try:
+    import fcntl
+except ImportError:  # Windows: sessiya fayli qulfi faqat jarayon ichida ishlaydi
+    fcntl = None
 
 logging.basicConfig(level=logging.INFO)
 load_dotenv()
@@ -23,13 +43,79 @@ ADMIN_ID = int(os.getenv("ADMIN_ID"))
 DEFAULT_AD_DELAY = int(os.getenv("AD_DELAY", 3600))
 DB_PATH = "bot_database.db"
 
+# Yuborish tezligi: har bir akkaunt uchun minutiga nechta xabar va bir martalik "burst"
+SEND_RATE = float(os.getenv("SEND_RATE", 4))
+SEND_BURST = int(os.getenv("SEND_BURST", 1))
+# Reja bo'yicha limitlar: plan_type -> (minutiga xabar, burst).
+# Har birini SEND_LIMITS_<REJA>="rate,burst" bilan almashtirish mumkin (masalan SEND_LIMITS_VIP="12,4")
+def plan_send_limit(plan_type, rate, burst):
+    value = os.getenv(f"SEND_LIMITS_{plan_type.upper()}")
+    if not value:
+        return rate, burst
+    rate, burst = value.split(",")
+    return float(rate), int(burst)
+
+PLAN_SEND_LIMITS = {
+    plan_type: plan_send_limit(plan_type, rate, burst)
+    for plan_type, (rate, burst) in {
+        "start": (SEND_RATE, SEND_BURST),
+        "3month": (6, 2),
+        "pro": (6, 2),
+        "year": (8, 3),
+        "vip": (10, 3),
+    }.items()
+}
+# Telegram papkalaridan yig'ilgan chatlar keshining amal qilish muddati (soniya)
+FOLDER_CACHE_TTL = int(os.getenv("FOLDER_CACHE_TTL", 1800))
+# Shundan uzun FloodWait olgan akkaunt kutmaydi, qolgan chatlari boshqa akkauntlarga o'tadi
+FLOOD_HANDOFF_SECONDS = int(os.getenv("FLOOD_HANDOFF_SECONDS", 300))
+# Outbox holatlari bazaga shuncha yozuvdan keyin bir partiyada yoziladi
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", 20))
+# Yetkazish jurnali: N yozuv yoki T soniyada bir marta bazaga yoziladi, eski yozuvlar R kundan keyin o'chiriladi
+DELIVERY_LOG_BATCH = int(os.getenv("DELIVERY_LOG_BATCH", 200))
+DELIVERY_LOG_FLUSH_SECONDS = int(os.getenv("DELIVERY_LOG_FLUSH_SECONDS", 5))
+DELIVERY_LOG_CAPACITY = int(os.getenv("DELIVERY_LOG_CAPACITY", 20000))
+DELIVERY_LOG_RETENTION_DAYS = int(os.getenv("DELIVERY_LOG_RETENTION_DAYS", 14))
+# Karantin: shuncha ketma-ket doimiy xatodan keyin chat karantinga olinadi va
+# QUARANTINE_BASE_SECONDS, keyin ikki baravardan (QUARANTINE_MAX_SECONDS gacha) oraliqda qayta tekshiriladi
+QUARANTINE_THRESHOLD = int(os.getenv("QUARANTINE_THRESHOLD", 2))
+QUARANTINE_BASE_SECONDS = int(os.getenv("QUARANTINE_BASE_SECONDS", 3600))
+QUARANTINE_MAX_SECONDS = int(os.getenv("QUARANTINE_MAX_SECONDS", 7 * 86400))
+# SQLite: o'qish uchun doimiy ulanishlar soni va bitta tranzaksiyaga yig'iladigan yozuvlar soni
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", 4))
+DB_WRITE_BATCH = int(os.getenv("DB_WRITE_BATCH", 100))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", 5000))
+# Obuna muddatini tekshiruvchi keyingi muddat tugashini kutadi, lekin shundan uzoq uxlamaydi (soniya)
+SUBSCRIPTION_SWEEP_MAX_SECONDS = int(os.getenv("SUBSCRIPTION_SWEEP_MAX_SECONDS", 3600))
+# FSM holatlari bazaga shuncha soniyada bir marta yoziladi; keshdagi yozuv shuncha soniya ishonchli
+# (bir nechta jarayonda ishlatilsa FSM_CACHE_SECONDS=0 qilib keshni o'chirish mumkin)
+FSM_FLUSH_SECONDS = float(os.getenv("FSM_FLUSH_SECONDS", 1))
+FSM_CACHE_SECONDS = float(os.getenv("FSM_CACHE_SECONDS", 300))
+# Telethon sessiyalaridagi o'zgarishlar (auth key, entitylar, update holati) shuncha soniyada bir yoziladi
+SESSION_FLUSH_SECONDS = float(os.getenv("SESSION_FLUSH_SECONDS", 2))
+# Dialoglar indeksi: o'zgarganlar shuncha soniyada bir tekshiriladi, to'liq qayta yig'ish esa shuncha soniyada bir
+DIALOG_SYNC_SECONDS = int(os.getenv("DIALOG_SYNC_SECONDS", 600))
+DIALOG_FULL_SYNC_SECONDS = int(os.getenv("DIALOG_FULL_SYNC_SECONDS", 86400))
+# Statistika hisoblagichlari bazadagi haqiqiy sonlar bilan shu oraliqda solishtiriladi (soniya)
+STATS_RECONCILE_SECONDS = int(os.getenv("STATS_RECONCILE_SECONDS", 3600))
+# Bir vaqtda ochiq turadigan Telethon ulanishlari soni va akkauntni tsikldan necha soniya oldin ulash
+CLIENT_POOL_SIZE = int(os.getenv("CLIENT_POOL_SIZE", 200))
+CLIENT_PREWARM_SECONDS = int(os.getenv("CLIENT_PREWARM_SECONDS", 30))
+# Ulangan klientning avtorizatsiyasi shuncha soniya qayta so'ralmaydi (auth xatosi kelsa darhol qayta tekshiriladi)
+CLIENT_AUTH_TTL = int(os.getenv("CLIENT_AUTH_TTL", 600))
+# Ishga tushishda: bir vaqtda ulanadigan sessiyalar, ulanishlar orasidagi oraliq (soniya, tasodifiy +-50%),
+# birinchi tsikllar tarqatiladigan oyna (soniya) va har necha sessiyada progress yozilishi
+WARMUP_CONCURRENCY = int(os.getenv("WARMUP_CONCURRENCY", 5))
+WARMUP_SPACING_SECONDS = float(os.getenv("WARMUP_SPACING_SECONDS", 0.5))
+STARTUP_RAMP_SECONDS = int(os.getenv("STARTUP_RAMP_SECONDS", 300))
+WARMUP_REPORT_EVERY = int(os.getenv("WARMUP_REPORT_EVERY", 25))
+
 if not os.path.exists("sessions"):
     os.makedirs("sessions")
 if not os.path.exists("payments"):
     os.makedirs("payments")
 
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
 users_data = {}
 
 class AuthState(StatesGroup):
@@ -50,139 +136,646 @@ class AuthState(StatesGroup):
     remove_admin_id = State()
     edit_payment_info = State()
 
-# --- Ma'lumotlar bazasi ---
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS subscriptions (
-                user_id INTEGER PRIMARY KEY,
-                expiry_date TEXT,
-                plan_type TEXT DEFAULT 'free'
-            )
-        """)
-        
-        # Migration: plan_type column'ini qo'shish (agar bo'lmasa)
+# --- Ma'lumotlar bazasi ulanishlari ---
+class Database:
+    """Umumiy SQLite ulanishlari (WAL): o'qish uchun pul, yozish uchun bitta navbatli ulanish"""
+
+    def __init__(self, path, read_pool_size):
+        self.path = path
+        self.read_pool_size = read_pool_size
+        self._readers = asyncio.Queue()
+        self._writer = None
+        self._writes = asyncio.Queue()
+        self._writer_task = None
+
+    async def _open(self, **kwargs):
+        conn = await aiosqlite.connect(self.path, cached_statements=256, **kwargs)
+        await conn.execute("PRAGMA journal_mode=WAL")
+        await conn.execute("PRAGMA synchronous=NORMAL")
+        await conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        return conn
+
+    async def connect(self):
+        # Yozuvchi autocommit rejimida: tranzaksiyalarni o'zimiz boshqaramiz
+        self._writer = await self._open(isolation_level=None)
+        for _ in range(self.read_pool_size):
+            self._readers.put_nowait(await self._open())
+        self._writer_task = asyncio.create_task(self._write_loop())
+        logging.info(f"Database opened: {self.read_pool_size} readers, 1 writer (WAL)")
+
+    async def fetchone(self, sql, params=()):
+        conn = await self._readers.get()
         try:
-            await db.execute("ALTER TABLE subscriptions ADD COLUMN plan_type TEXT DEFAULT 'free'")
-            await db.commit()
-            logging.info("Added plan_type column to subscriptions table")
-        except Exception as e:
-            if "duplicate column name" in str(e):
-                logging.info("plan_type column already exists")
+            async with conn.execute(sql, params) as cursor:
+                return await cursor.fetchone()
+        finally:
+            self._readers.put_nowait(conn)
+
+    async def fetchall(self, sql, params=()):
+        conn = await self._readers.get()
+        try:
+            async with conn.execute(sql, params) as cursor:
+                return await cursor.fetchall()
+        finally:
+            self._readers.put_nowait(conn)
+
+    async def transaction(self, fn):
+        """fn(db) yozuvchi ulanishda atomar bajariladi; commit bo'lgach natijasi qaytadi"""
+        future = asyncio.get_running_loop().create_future()
+        self._writes.put_nowait((fn, future))
+        return await future
+
+    async def execute(self, sql, params=()):
+        """Bitta yozuv; cursor qaytadi (lastrowid / rowcount uchun)"""
+        async def op(db):
+            return await db.execute(sql, params)
+        return await self.transaction(op)
+
+    async def executemany(self, sql, rows):
+        async def op(db):
+            return await db.executemany(sql, rows)
+        return await self.transaction(op)
+
+    async def _write_loop(self):
+        # Navbatdagi yozuvlar bitta BEGIN ... COMMIT ga yig'iladi, har biri o'z SAVEPOINT'ida:
+        # bittasining xatosi qolganlarini bekor qilmaydi
+        while True:
+            item = await self._writes.get()
+            if item is None:
+                return
+            batch = [item]
+            stop = False
+            while len(batch) < DB_WRITE_BATCH and not self._writes.empty():
+                item = self._writes.get_nowait()
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            
+            done = []
+            try:
+                await self._writer.execute("BEGIN")
+                for fn, future in batch:
+                    await self._writer.execute("SAVEPOINT op")
+                    try:
+                        result = await fn(self._writer)
+                    except Exception as e:
+                        await self._writer.execute("ROLLBACK TO op")
+                        await self._writer.execute("RELEASE op")
+                        if not future.done():
+                            future.set_exception(e)
+                    else:
+                        await self._writer.execute("RELEASE op")
+                        done.append((future, result))
+                await self._writer.execute("COMMIT")
+            except Exception as e:
+                logging.error(f"Database write batch failed: {e}")
+                try:
+                    await self._writer.execute("ROLLBACK")
+                except Exception:
+                    pass
+                for fn, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            for future, result in done:
+                if not future.done():
+                    future.set_result(result)
+            if stop:
+                return
+
+    async def close(self):
+        if self._writer_task:
+            self._writes.put_nowait(None)
+            await self._writer_task
+            self._writer_task = None
+        if self._writer:
+            await self._writer.close()
+            self._writer = None
+        while not self._readers.empty():
+            await self._readers.get_nowait().close()
+
+database = Database(DB_PATH, DB_READ_POOL_SIZE)
+
+class DebouncedFlush:
+    """Xotiradagi o'zgarishlarni delay soniya yig'ib, bitta fon taskidan flush() bilan yozish.
+    Flush paytida kelgan o'zgarishlar ham shu task bilan yoziladi (has_pending() False bo'lguncha)."""
+
+    def __init__(self, flush, has_pending, delay):
+        self._flush = flush
+        self._has_pending = has_pending
+        self._delay = delay
+        self._task = None
+
+    def schedule(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self._has_pending():
+            await asyncio.sleep(self._delay)
+            await self._flush()
+
+    async def close(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+        await self._flush()
+
+# --- FSM Holatlari Ombori ---
+class SQLiteStorage(BaseStorage):
+    """aiogram FSM holatlari bazada (fsm_states jadvali): restartdan keyin ham jarayonlar davom etadi.
+    O'qishlar keshdan, yozuvlar FSM_FLUSH_SECONDS ichida bitta partiyaga yig'ilib yoziladi."""
+
+    def __init__(self):
+        self.key_builder = DefaultKeyBuilder(with_destiny=True)
+        # key -> (keshlangan vaqt, state, data)
+        self._cache = {}
+        self._dirty = set()
+        self._writer = DebouncedFlush(self.flush, lambda: bool(self._dirty), FSM_FLUSH_SECONDS)
+        self._pruned_at = time.monotonic()
+
+    async def _load(self, key):
+        entry = self._cache.get(key)
+        if entry and (key in self._dirty or time.monotonic() - entry[0] < FSM_CACHE_SECONDS):
+            return entry
+        row = await database.fetchone("SELECT state, data FROM fsm_states WHERE key = ?", (key,))
+        entry = (time.monotonic(), row[0] if row else None, json.loads(row[1]) if row and row[1] else {})
+        self._cache[key] = entry
+        return entry
+
+    def _store(self, key, state, data):
+        self._cache[key] = (time.monotonic(), state, data)
+        self._dirty.add(key)
+        self._writer.schedule()
+
+    def _prune(self):
+        """Eskirgan kesh yozuvlarini tashlash (TTL da bir martadan ko'p emas)"""
+        now = time.monotonic()
+        if now - self._pruned_at < FSM_CACHE_SECONDS:
+            return
+        self._pruned_at = now
+        for key in [k for k, entry in self._cache.items() if now - entry[0] >= FSM_CACHE_SECONDS and k not in self._dirty]:
+            del self._cache[key]
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        upserts, deletes = [], []
+        now = int(time.time())
+        for key in keys:
+            _, state, data = self._cache[key]
+            if state is None and not data:
+                deletes.append((key,))
             else:
-                logging.error(f"Error adding plan_type column: {e}")
-        
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS profiles (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                phone TEXT,
-                session_name TEXT,
-                is_active INTEGER DEFAULT 1,
-                created_at TEXT
-            )
-        """)
-        
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS groups (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                folder_name TEXT,
-                group_ids TEXT,
-                created_at TEXT
-            )
-        """)
-        
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS payment_requests (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                plan_type TEXT,
-                amount INTEGER,
-                screenshot_path TEXT,
-                status TEXT DEFAULT 'pending',
-                created_at TEXT
-            )
-        """)
-        
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS ad_templates (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                text TEXT,
-                image_path TEXT,
-                created_at TEXT
-            )
-        """)
+                upserts.append((key, state, json.dumps(data), now))
         
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS admins (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                admin_id INTEGER UNIQUE,
-                username TEXT,
-                added_by INTEGER,
-                created_at TEXT
-            )
-        """)
-        
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS pricing (
-                plan_type TEXT PRIMARY KEY,
-                duration_days INTEGER,
-                price INTEGER
-            )
-        """)
-        
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                full_name TEXT,
-                created_at TEXT
-            )
-        """)
-        
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS user_settings (
-                user_id INTEGER PRIMARY KEY,
-                is_running INTEGER DEFAULT 0,
-                interval INTEGER,
-                ad_text TEXT,
-                image_path TEXT,
-                video_path TEXT,
-                voice_path TEXT
-            )
-        """)
-        
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS payment_info (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                card_number TEXT,
-                card_holder TEXT,
-                amount INTEGER,
-                created_at TEXT
-            )
-        """)
-        
-        # Unique index for groups to prevent duplicates
+        async def op(db):
+            if upserts:
+                await db.executemany("INSERT OR REPLACE INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?)", upserts)
+            if deletes:
+                await db.executemany("DELETE FROM fsm_states WHERE key = ?", deletes)
         try:
-            await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_user_folder ON groups(user_id, folder_name)")
-        except:
-            pass
+            await database.transaction(op)
+        except Exception as e:
+            logging.error(f"Error flushing FSM states: {e}")
+            # Keyingi flushda qayta urinamiz (shu orada o'zgarganlari allaqachon dirty)
+            self._dirty.update(keys)
+        self._prune()
+
+    async def set_state(self, key, state=None):
+        key = self.key_builder.build(key)
+        _, _, data = await self._load(key)
+        self._store(key, state.state if hasattr(state, "state") else state, data)
+
+    async def get_state(self, key):
+        return (await self._load(self.key_builder.build(key)))[1]
+
+    async def set_data(self, key, data):
+        key = self.key_builder.build(key)
+        _, state, _ = await self._load(key)
+        self._store(key, state, dict(data))
+
+    async def get_data(self, key):
+        return dict((await self._load(self.key_builder.build(key)))[2])
+
+    async def close(self):
+        await self._writer.close()
+
+fsm_storage = SQLiteStorage()
+dp = Dispatcher(storage=fsm_storage)
+
+# --- Ma'lumotlar bazasi ---
+async def column_exists(db, table, column):
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        return any(row[1] == column for row in await cursor.fetchall())
+
+async def migration_001_base(db):
+    """Asosiy jadvallar va default narxlar"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            user_id INTEGER PRIMARY KEY,
+            expiry_date TEXT,
+            plan_type TEXT DEFAULT 'free'
+        )
+    """)
+    
+    # Eski bazalarda plan_type ustuni bo'lmasligi mumkin
+    if not await column_exists(db, "subscriptions", "plan_type"):
+        await db.execute("ALTER TABLE subscriptions ADD COLUMN plan_type TEXT DEFAULT 'free'")
+        logging.info("Added plan_type column to subscriptions table")
+    
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS profiles (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            phone TEXT,
+            session_name TEXT,
+            is_active INTEGER DEFAULT 1,
+            created_at TEXT
+        )
+    """)
+    
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS groups (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            folder_name TEXT,
+            group_ids TEXT,
+            created_at TEXT
+        )
+    """)
+    
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS payment_requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            plan_type TEXT,
+            amount INTEGER,
+            screenshot_path TEXT,
+            status TEXT DEFAULT 'pending',
+            created_at TEXT
+        )
+    """)
+    
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS ad_templates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            text TEXT,
+            image_path TEXT,
+            created_at TEXT
+        )
+    """)
+    
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS admins (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER UNIQUE,
+            username TEXT,
+            added_by INTEGER,
+            created_at TEXT
+        )
+    """)
+    
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS pricing (
+            plan_type TEXT PRIMARY KEY,
+            duration_days INTEGER,
+            price INTEGER
+        )
+    """)
+    
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            full_name TEXT,
+            created_at TEXT
+        )
+    """)
+    
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS user_settings (
+            user_id INTEGER PRIMARY KEY,
+            is_running INTEGER DEFAULT 0,
+            interval INTEGER,
+            ad_text TEXT,
+            image_path TEXT,
+            video_path TEXT,
+            voice_path TEXT
+        )
+    """)
+    
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS payment_info (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            card_number TEXT,
+            card_holder TEXT,
+            amount INTEGER,
+            created_at TEXT
+        )
+    """)
+    
+    # Unique index for groups to prevent duplicates
+    try:
+        await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_user_folder ON groups(user_id, folder_name)")
+    except Exception as e:
+        logging.error(f"Error creating idx_user_folder: {e}")
+    
+    # Default narxlar faqat bir marta qo'shiladi - admin o'zgartirgan narxlar saqlanib qoladi
+    await db.execute("""
+        INSERT OR IGNORE INTO pricing (plan_type, duration_days, price) VALUES
+        ('start', 30, 50000),
+        ('3month', 90, 120000),
+        ('pro', 180, 200000),
+        ('year', 365, 350000),
+        ('vip', 9999, 500000)
+    """)
+
+async def migration_002_outbox(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            user_id INTEGER,
+            cycle_id INTEGER,
+            account TEXT,
+            target_id INTEGER,
+            state TEXT DEFAULT 'pending',
+            PRIMARY KEY (user_id, cycle_id, target_id)
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(user_id, state)")
+
+async def migration_003_deliveries(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS deliveries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at INTEGER,
+            user_id INTEGER,
+            account TEXT,
+            target_id INTEGER,
+            status TEXT,
+            latency_ms INTEGER,
+            error TEXT
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_deliveries_created ON deliveries(created_at)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_deliveries_user ON deliveries(user_id, created_at)")
+
+async def migration_004_quarantine(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS quarantine (
+            account TEXT,
+            target_id INTEGER,
+            failures INTEGER,
+            error TEXT,
+            next_probe_at INTEGER,
+            PRIMARY KEY (account, target_id)
+        )
+    """)
+
+async def migration_005_group_targets(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS group_targets (
+            user_id INTEGER,
+            folder_id INTEGER,
+            target_id INTEGER,
+            access_hash INTEGER,
+            added_at INTEGER,
+            PRIMARY KEY (folder_id, target_id)
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_group_targets_user ON group_targets(user_id, target_id)")
+    
+    # Migration: groups.group_ids (vergul bilan ajratilgan matn) -> group_targets
+    async with db.execute("SELECT id, user_id, group_ids FROM groups WHERE group_ids IS NOT NULL AND group_ids != ''") as cursor:
+        legacy = await cursor.fetchall()
+    if legacy:
+        now = int(time.time())
+        rows = []
+        for folder_id, user_id, group_ids in legacy:
+            for gid in group_ids.split(","):
+                try:
+                    rows.append((user_id, folder_id, int(gid), None, now))
+                except ValueError:
+                    logging.warning(f"Skipping bad group id {gid!r} in folder {folder_id}")
+        await db.executemany(
+            "INSERT OR IGNORE INTO group_targets (user_id, folder_id, target_id, access_hash, added_at) VALUES (?, ?, ?, ?, ?)",
+            rows
+        )
+        await db.execute("UPDATE groups SET group_ids = NULL")
+        logging.info(f"Migrated {len(rows)} group ids from {len(legacy)} folders to group_targets")
+
+async def migration_006_expiry_ts(db):
+    """Obuna muddati indekslangan butun son (epoch) sifatida ham saqlanadi"""
+    if not await column_exists(db, "subscriptions", "expiry_ts"):
+        await db.execute("ALTER TABLE subscriptions ADD COLUMN expiry_ts INTEGER")
+    async with db.execute("SELECT user_id, expiry_date FROM subscriptions") as cursor:
+        rows = await cursor.fetchall()
+    updates = []
+    for user_id, expiry_date in rows:
+        try:
+            updates.append((int(datetime.strptime(expiry_date, "%Y-%m-%d %H:%M:%S").timestamp()), user_id))
+        except (TypeError, ValueError):
+            logging.warning(f"Bad expiry_date for user {user_id}: {expiry_date!r}")
+    await db.executemany("UPDATE subscriptions SET expiry_ts = ? WHERE user_id = ?", updates)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_expiry ON subscriptions(expiry_ts)")
+
+async def migration_007_subscription_plan_index(db):
+    # Admin foydalanuvchilar ro'yxati plan_type bo'yicha user_id tartibida sahifalanadi
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_plan ON subscriptions(plan_type, user_id)")
+
+async def migration_008_fsm_states(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at INTEGER
+        )
+    """)
+
+async def migration_009_telethon_sessions(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS tg_sessions (
+            key TEXT PRIMARY KEY,
+            dc_id INTEGER,
+            server_address TEXT,
+            port INTEGER,
+            auth_key BLOB,
+            takeout_id INTEGER,
+            updated_at INTEGER
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS tg_entities (
+            key TEXT,
+            id INTEGER,
+            hash INTEGER NOT NULL,
+            username TEXT,
+            phone TEXT,
+            name TEXT,
+            PRIMARY KEY (key, id)
+        ) WITHOUT ROWID
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS tg_update_states (
+            key TEXT,
+            id INTEGER,
+            pts INTEGER,
+            qts INTEGER,
+            date INTEGER,
+            seq INTEGER,
+            PRIMARY KEY (key, id)
+        ) WITHOUT ROWID
+    """)
+
+async def migration_010_dialogs(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS dialogs (
+            account_key TEXT,
+            peer_id INTEGER,
+            access_hash INTEGER,
+            is_user INTEGER,
+            is_group INTEGER,
+            is_channel INTEGER,
+            archived INTEGER,
+            contact INTEGER,
+            bot INTEGER,
+            top_message INTEGER,
+            PRIMARY KEY (account_key, peer_id)
+        ) WITHOUT ROWID
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS dialog_sync (
+            account_key TEXT PRIMARY KEY,
+            full_synced_at INTEGER
+        )
+    """)
+
+async def migration_011_outbox_candidates(db):
+    # Chatga a'zo akkauntlar (vergul bilan) - resume'da chat a'zo bo'lmagan akkauntga berilmaydi
+    if not await column_exists(db, "outbox", "candidates"):
+        await db.execute("ALTER TABLE outbox ADD COLUMN candidates TEXT")
+
+# Tartib raqami = PRAGMA user_version. Yangi migratsiya faqat oxiriga qo'shiladi, mavjudlari o'zgartirilmaydi.
+# Versiyasi 0 bo'lgan eski bazalarda jadvallar allaqachon bo'lishi mumkin, shuning uchun IF NOT EXISTS.
+MIGRATIONS = [
+    migration_001_base,
+    migration_002_outbox,
+    migration_003_deliveries,
+    migration_004_quarantine,
+    migration_005_group_targets,
+    migration_006_expiry_ts,
+    migration_007_subscription_plan_index,
+    migration_008_fsm_states,
+    migration_009_telethon_sessions,
+    migration_010_dialogs,
+    migration_011_outbox_candidates,
+]
+
+async def init_db():
+    """Faqat qo'llanmagan migratsiyalarni bajarish; sxema yangi bo'lsa bitta PRAGMA o'qiladi"""
+    version = (await database.fetchone("PRAGMA user_version"))[0]
+    if version >= len(MIGRATIONS):
+        return
+    
+    async def apply(db):
+        for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+            await migration(db)
+            await db.execute(f"PRAGMA user_version = {number}")
+            logging.info(f"Applied migration {number}: {migration.__name__}")
+    await database.transaction(apply)
+
+# --- Obuna va Adminlar Keshi ---
+class AccessCache:
+    """user_id -> (obuna tugash vaqti (epoch), plan_type, is_admin). Startda yuklanadi, yozuvlar bilan birga yangilanadi."""
+
+    def __init__(self):
+        self._entries = {}
+
+    async def load(self):
+        entries = {}
+        for user_id, expiry_ts, plan_type in await database.fetchall("SELECT user_id, expiry_ts, plan_type FROM subscriptions WHERE expiry_ts IS NOT NULL"):
+            entries[user_id] = (expiry_ts, plan_type, False)
+        for (admin_id,) in await database.fetchall("SELECT admin_id FROM admins"):
+            expiry_ts, plan_type, _ = entries.get(admin_id, (None, None, False))
+            entries[admin_id] = (expiry_ts, plan_type, True)
+        self._entries = entries
+        logging.info(f"Access cache loaded: {len(entries)} users")
+
+    def get(self, user_id):
+        return self._entries.get(user_id, (None, None, False))
+
+    def has_subscription(self, user_id):
+        expiry_ts = self.get(user_id)[0]
+        return expiry_ts is not None and expiry_ts > time.time()
+
+    def set_subscription(self, user_id, expiry_ts, plan_type):
+        self._entries[user_id] = (expiry_ts, plan_type, self.get(user_id)[2])
+
+    def remove_subscription(self, user_id):
+        self._entries[user_id] = (None, None, self.get(user_id)[2])
+
+    def set_admin(self, user_id, is_admin_user):
+        expiry_ts, plan_type, _ = self.get(user_id)
+        self._entries[user_id] = (expiry_ts, plan_type, is_admin_user)
+
+access_cache = AccessCache()
+
+# --- Statistika Hisoblagichlari ---
+class StatsCounters:
+    """Statistika sahifalari uchun xotiradagi hisoblagichlar.
+    Yozuv joylarida o'zgartiriladi, reconcile() esa bazadan qayta hisoblab farqni tuzatadi."""
+
+    def __init__(self):
+        self.subscriptions = 0
+        self.running = set()
+        self.profiles = {}
+        self.groups = {}
+
+    def bump(self, counter, user_id, delta=1):
+        counter[user_id] = max(0, counter.get(user_id, 0) + delta)
+
+    def set_running(self, user_id, is_running):
+        if is_running:
+            self.running.add(user_id)
+        else:
+            self.running.discard(user_id)
 
-        await db.commit()
+    async def reconcile(self):
+        subscriptions = (await database.fetchone("SELECT COUNT(*) FROM subscriptions"))[0]
+        running = {row[0] for row in await database.fetchall("SELECT user_id FROM user_settings WHERE is_running = 1")}
+        profiles = dict(await database.fetchall("SELECT user_id, COUNT(*) FROM profiles GROUP BY user_id"))
+        groups = dict(await database.fetchall("SELECT user_id, COUNT(*) FROM groups GROUP BY user_id"))
         
-        # Default narxlarni qo'shish
-        await db.execute("DELETE FROM pricing")
-        await db.execute("""
-            INSERT INTO pricing (plan_type, duration_days, price) VALUES
-            ('start', 30, 50000),
-            ('3month', 90, 120000),
-            ('pro', 180, 200000),
-            ('year', 365, 350000),
-            ('vip', 9999, 500000)
-        """)
-        await db.commit()
+        drift = []
+        if subscriptions != self.subscriptions:
+            drift.append(f"subscriptions {self.subscriptions}->{subscriptions}")
+        if running != self.running:
+            drift.append(f"running {len(self.running)}->{len(running)}")
+        if profiles != {k: v for k, v in self.profiles.items() if v}:
+            drift.append("profiles")
+        if groups != {k: v for k, v in self.groups.items() if v}:
+            drift.append("groups")
+        if drift:
+            logging.info(f"Stats reconciled: {', '.join(drift)}")
+        
+        self.subscriptions = subscriptions
+        self.running = running
+        self.profiles = profiles
+        self.groups = groups
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(STATS_RECONCILE_SECONDS)
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logging.error(f"Stats reconcile failed: {e}")
+
+stats = StatsCounters()
 
 async def add_subscription(user_id: int, days: int, plan_type: str = "free"):
     expiry_date = datetime.now() + timedelta(days=days)
@@ -190,39 +783,64 @@ async def add_subscription(user_id: int, days: int, plan_type: str = "free"):
         expiry_date_str = "2099-12-31 23:59:59"
     else:
         expiry_date_str = expiry_date.strftime("%Y-%m-%d %H:%M:%S")
+    expiry_ts = int(datetime.strptime(expiry_date_str, "%Y-%m-%d %H:%M:%S").timestamp())
+    is_new = access_cache.get(user_id)[0] is None
         
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            INSERT OR REPLACE INTO subscriptions (user_id, expiry_date, plan_type)
-            VALUES (?, ?, ?)
-        """, (user_id, expiry_date_str, plan_type))
-        await db.commit()
+    await database.execute("""
+        INSERT OR REPLACE INTO subscriptions (user_id, expiry_date, plan_type, expiry_ts)
+        VALUES (?, ?, ?, ?)
+    """, (user_id, expiry_date_str, plan_type, expiry_ts))
+    access_cache.set_subscription(user_id, expiry_ts, plan_type)
+    if is_new:
+        stats.subscriptions += 1
+    subscription_sweeper.wake()
 
 async def check_subscription(user_id: int):
     if user_id == ADMIN_ID:
         return True
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT expiry_date FROM subscriptions WHERE user_id = ?", (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            if row:
-                expiry_date = datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S")
-                return expiry_date > datetime.now()
-    return False
+    return access_cache.has_subscription(user_id)
 
 # --- Admin Tekshirish ---
 async def is_admin(user_id: int) -> bool:
     if user_id == ADMIN_ID:
         return True
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT admin_id FROM admins WHERE admin_id = ?", (user_id,)) as cursor:
-            result = await cursor.fetchone()
-    return result is not None
+    return access_cache.get(user_id)[2]
+
+# --- Narxlar va Klaviaturalar Keshi ---
+# [(plan_type, duration_days, price), ...] - birinchi so'rovda yuklanadi, narx o'zgarsa tozalanadi
+_pricing = None
+# Tayyor klaviaturalar va matnlar: ular faqat narxlar va (ulangan, obuna, admin) holatiga bog'liq
+_render_cache = {}
+
+async def get_prices():
+    global _pricing
+    if _pricing is None:
+        _pricing = list(await database.fetchall("SELECT plan_type, duration_days, price FROM pricing ORDER BY duration_days"))
+    return _pricing
+
+async def get_price(plan_type):
+    """(duration_days, price) yoki None"""
+    for plan, days, price in await get_prices():
+        if plan == plan_type:
+            return days, price
+    return None
+
+def invalidate_pricing():
+    global _pricing
+    _pricing = None
+    _render_cache.clear()
 
 # --- Klaviaturalar ---
 async def get_main_keyboard(user_id, is_connected=False):
     is_admin_user = await is_admin(user_id)
     has_sub = await check_subscription(user_id)
     
+    key = ("main", is_connected, has_sub, is_admin_user)
+    if key not in _render_cache:
+        _render_cache[key] = await build_main_keyboard(is_connected, has_sub, is_admin_user)
+    return _render_cache[key]
+
+async def build_main_keyboard(is_connected, has_sub, is_admin_user):
     if not is_connected:
         buttons = [[KeyboardButton(text="📱 Akkountga ulanish")]]
         if is_admin_user:
@@ -255,10 +873,10 @@ async def admin_panel_text_btn(message: types.Message):
         await show_admin_panel(message)
 
 async def get_subscription_keyboard():
-    """Bazadagi narxlardan obuna tugmalarini yaratadi"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT plan_type, duration_days, price FROM pricing ORDER BY duration_days") as cursor:
-            prices = await cursor.fetchall()
+    """Narxlardan obuna tugmalarini yaratadi (keshlanadi)"""
+    if "subscription" in _render_cache:
+        return _render_cache["subscription"]
+    prices = await get_prices()
     
     plan_buttons = {
         "start": "buy_start",
@@ -282,71 +900,459 @@ async def get_subscription_keyboard():
                 callback_data=plan_buttons[plan_type]
             )])
     kb.append([InlineKeyboardButton(text="👤 Admin bilan bog'lanish", url=f"tg://user?id={ADMIN_ID}")])
-    return InlineKeyboardMarkup(inline_keyboard=kb)
+    _render_cache["subscription"] = InlineKeyboardMarkup(inline_keyboard=kb)
+    return _render_cache["subscription"]
 
 async def send_sub_msg(message: types.Message):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT plan_type, duration_days, price FROM pricing ORDER BY duration_days") as cursor:
-            prices = await cursor.fetchall()
-    plan_names = {"start": "Start — 1 oy", "3month": "Pro — 3 oy", "pro": "Pro — 6 oy", "year": "VIP — 1 yil", "vip": "VIP — Umrbod"}
-    text = "🔥 **Obuna turlarini tanlang:**\n\n"
-    for plan, days, price in prices:
-        if plan in plan_names:
-            text += f"🔹 {plan_names[plan]}: {price:,} so'm\n"
-    text += "\n⏱ Istalgan vaqtda, istalgan guruhga, istagan e'loningizni avtomatik yuboradi!"
+    text = _render_cache.get("subscription_text")
+    if text is None:
+        prices = await get_prices()
+        plan_names = {"start": "Start — 1 oy", "3month": "Pro — 3 oy", "pro": "Pro — 6 oy", "year": "VIP — 1 yil", "vip": "VIP — Umrbod"}
+        text = "🔥 **Obuna turlarini tanlang:**\n\n"
+        for plan, days, price in prices:
+            if plan in plan_names:
+                text += f"🔹 {plan_names[plan]}: {price:,} so'm\n"
+        text += "\n⏱ Istalgan vaqtda, istalgan guruhga, istagan e'loningizni avtomatik yuboradi!"
+        _render_cache["subscription_text"] = text
     await message.answer(text, reply_markup=await get_subscription_keyboard(), parse_mode="Markdown")
 
+# --- Telethon Sessiyalari Ombori ---
+class StoredSession(MemorySession):
+    """Telethon sessiyasi umumiy bazada (tg_sessions, tg_entities, tg_update_states).
+    Hammasi xotirada ishlaydi, o'zgarishlar session_store orqali partiya bilan yoziladi."""
+
+    def __init__(self, key):
+        super().__init__()
+        self.key = key
+        # id -> (id, hash, username, phone, name); MemorySession'dagi set o'rniga tez qidirish uchun
+        self._entities = {}
+
+    def set_dc(self, dc_id, server_address, port):
+        super().set_dc(dc_id, server_address, port)
+        session_store.mark(self)
+
+    @property
+    def auth_key(self):
+        return self._auth_key
+
+    @auth_key.setter
+    def auth_key(self, value):
+        self._auth_key = value
+        session_store.mark(self)
+
+    @property
+    def takeout_id(self):
+        return self._takeout_id
+
+    @takeout_id.setter
+    def takeout_id(self, value):
+        self._takeout_id = value
+        session_store.mark(self)
+
+    def set_update_state(self, entity_id, state):
+        super().set_update_state(entity_id, state)
+        session_store.mark_state(self.key, entity_id, state)
+
+    def process_entities(self, tlo):
+        changed = []
+        for row in self._entities_to_rows(tlo):
+            if self._entities.get(row[0]) != row:
+                self._entities[row[0]] = row
+                changed.append(row)
+        if changed:
+            session_store.mark_entities(self.key, changed)
+
+    def get_entity_rows_by_id(self, id, exact=True):
+        ids = [id] if exact else [utils.get_peer_id(peer(id)) for peer in (PeerUser, PeerChat, PeerChannel)]
+        for found_id in ids:
+            row = self._entities.get(found_id)
+            if row:
+                return row[0], row[1]
+
+    def get_entity_rows_by_phone(self, phone):
+        return next(((row[0], row[1]) for row in self._entities.values() if row[3] == phone), None)
+
+    def get_entity_rows_by_username(self, username):
+        return next(((row[0], row[1]) for row in self._entities.values() if row[2] == username), None)
+
+    def get_entity_rows_by_name(self, name):
+        return next(((row[0], row[1]) for row in self._entities.values() if row[4] == name), None)
+
+    def clone(self, to_instance=None):
+        # CDN/eksport qilingan DC ulanishlari vaqtinchalik, bazaga yozilmaydi
+        return to_instance or MemorySession()
+
+    def save(self):
+        session_store.schedule_flush()
+
+    def delete(self):
+        session_store.forget(self.key)
+
+class SessionStore:
+    """Barcha akkauntlarning Telethon sessiyalari bitta bazada (har biriga alohida .session fayl o'rniga).
+    O'zgarishlar SESSION_FLUSH_SECONDS ichida yig'ilib bitta tranzaksiyada yoziladi."""
+
+    def __init__(self):
+        self._keys = set()              # auth_key'i saqlangan sessiyalar
+        self._dirty_sessions = {}       # key -> StoredSession
+        self._dirty_entities = {}       # key -> {id: row}
+        self._dirty_states = {}         # key -> {entity_id: State}
+        self._deleted = set()
+        self._writer = DebouncedFlush(
+            self.flush,
+            lambda: bool(self._dirty_sessions or self._dirty_entities or self._dirty_states or self._deleted),
+            SESSION_FLUSH_SECONDS,
+        )
+
+    async def load_keys(self):
+        rows = await database.fetchall("SELECT key FROM tg_sessions WHERE auth_key IS NOT NULL")
+        self._keys = {key for (key,) in rows}
+        logging.info(f"Session store loaded: {len(self._keys)} sessions")
+
+    def has(self, key):
+        return key in self._keys
+
+    async def open(self, key):
+        """Bazadagi sessiyani xotiraga yuklash (bo'lmasa bo'sh sessiya)"""
+        session = StoredSession(key)
+        if key not in self._keys:
+            return session
+        row = await database.fetchone("SELECT dc_id, server_address, port, auth_key, takeout_id FROM tg_sessions WHERE key = ?", (key,))
+        if row:
+            session._dc_id, session._server_address, session._port, auth_key, session._takeout_id = row
+            session._auth_key = AuthKey(data=auth_key) if auth_key else None
+        for row in await database.fetchall("SELECT id, hash, username, phone, name FROM tg_entities WHERE key = ?", (key,)):
+            session._entities[row[0]] = tuple(row)
+        for entity_id, pts, qts, date, seq in await database.fetchall("SELECT id, pts, qts, date, seq FROM tg_update_states WHERE key = ?", (key,)):
+            session._update_states[entity_id] = UpdatesState(
+                pts=pts, qts=qts, date=datetime.fromtimestamp(date, tz=timezone.utc), seq=seq, unread_count=0
+            )
+        return session
+
+    def mark(self, session):
+        if session.auth_key:
+            self._keys.add(session.key)
+        self._dirty_sessions[session.key] = session
+        self.schedule_flush()
+
+    def mark_entities(self, key, rows):
+        self._dirty_entities.setdefault(key, {}).update((row[0], row) for row in rows)
+        self.schedule_flush()
+
+    def mark_state(self, key, entity_id, state):
+        self._dirty_states.setdefault(key, {})[entity_id] = state
+        self.schedule_flush()
+
+    def forget(self, key):
+        """Sessiyani o'chirish (logout yoki buzilgan auth key)"""
+        self._keys.discard(key)
+        self._dirty_sessions.pop(key, None)
+        self._dirty_entities.pop(key, None)
+        self._dirty_states.pop(key, None)
+        self._deleted.add(key)
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        self._writer.schedule()
+
+    async def flush(self):
+        deleted, self._deleted = self._deleted, set()
+        sessions, self._dirty_sessions = self._dirty_sessions, {}
+        entities, self._dirty_entities = self._dirty_entities, {}
+        states, self._dirty_states = self._dirty_states, {}
+        if not (deleted or sessions or entities or states):
+            return
+
+        now = int(time.time())
+        session_rows = [
+            (key, s.dc_id, s.server_address, s.port, s.auth_key.key if s.auth_key else None, s.takeout_id, now)
+            for key, s in sessions.items()
+        ]
+        entity_rows = [(key,) + row for key, rows in entities.items() for row in rows.values()]
+        state_rows = [
+            (key, entity_id, state.pts, state.qts, int(state.date.timestamp()), state.seq)
+            for key, key_states in states.items() for entity_id, state in key_states.items()
+        ]
+
+        async def op(db):
+            for key in deleted:
+                for table in ("tg_sessions", "tg_entities", "tg_update_states"):
+                    await db.execute(f"DELETE FROM {table} WHERE key = ?", (key,))
+            if session_rows:
+                await db.executemany("""
+                    INSERT OR REPLACE INTO tg_sessions (key, dc_id, server_address, port, auth_key, takeout_id, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, session_rows)
+            if entity_rows:
+                await db.executemany("INSERT OR REPLACE INTO tg_entities (key, id, hash, username, phone, name) VALUES (?, ?, ?, ?, ?, ?)", entity_rows)
+            if state_rows:
+                await db.executemany("INSERT OR REPLACE INTO tg_update_states (key, id, pts, qts, date, seq) VALUES (?, ?, ?, ?, ?, ?)", state_rows)
+        try:
+            await database.transaction(op)
+        except Exception as e:
+            logging.error(f"Error flushing Telethon sessions: {e}")
+            # Keyingi flushda qayta urinamiz; shu orada kelgan yangiroq o'zgarishlar ustun
+            self._deleted |= deleted
+            for key, session in sessions.items():
+                self._dirty_sessions.setdefault(key, session)
+            for pending, failed in ((self._dirty_entities, entities), (self._dirty_states, states)):
+                for key, rows in failed.items():
+                    pending[key] = {**rows, **pending.get(key, {})}
+
+    async def close(self):
+        await self._writer.close()
+
+    async def import_legacy(self):
+        """sessions/*.session fayllarini bazaga ko'chirish. Ko'chirilgan fayllar sessions/legacy/ ga o'tkaziladi."""
+        names = [name[:-len(".session")] for name in os.listdir("sessions") if name.endswith(".session")]
+        if not names:
+            return
+        imported = 0
+        os.makedirs("sessions/legacy", exist_ok=True)
+        for key in names:
+            path = f"sessions/{key}.session"
+            try:
+                session, entities, states = await asyncio.to_thread(read_legacy_session, path)
+            except Exception as e:
+                logging.error(f"Failed to read legacy session {path}: {e}")
+                continue
+            if session is not None and key not in self._keys:
+                async def op(db):
+                    await db.execute("""
+                        INSERT OR REPLACE INTO tg_sessions (key, dc_id, server_address, port, auth_key, takeout_id, updated_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """, (key,) + session + (int(time.time()),))
+                    await db.executemany("INSERT OR REPLACE INTO tg_entities (key, id, hash, username, phone, name) VALUES (?, ?, ?, ?, ?, ?)", [(key,) + row for row in entities])
+                    await db.executemany("INSERT OR REPLACE INTO tg_update_states (key, id, pts, qts, date, seq) VALUES (?, ?, ?, ?, ?, ?)", [(key,) + row for row in states])
+                await database.transaction(op)
+                self._keys.add(key)
+                imported += 1
+            for ext in (".session", ".session-journal"):
+                if os.path.exists(f"sessions/{key}{ext}"):
+                    os.replace(f"sessions/{key}{ext}", f"sessions/legacy/{key}{ext}")
+        logging.info(f"Imported {imported} of {len(names)} legacy session files into the session store")
+
+def read_legacy_session(path):
+    """Telethon SQLiteSession faylidan (auth qatori, entitylar, update holatlari) o'qish"""
+    conn = sqlite3.connect(path)
+    try:
+        conn.row_factory = sqlite3.Row
+        row = conn.execute("SELECT * FROM sessions").fetchone()
+        if row is None or not row["auth_key"]:
+            return None, [], []
+        session = (row["dc_id"], row["server_address"], row["port"], row["auth_key"],
+                   row["takeout_id"] if "takeout_id" in row.keys() else None)
+        entities = [tuple(r) for r in conn.execute("SELECT id, hash, username, phone, name FROM entities")]
+        states = [tuple(r) for r in conn.execute("SELECT id, pts, qts, date, seq FROM update_state")]
+        return session, entities, states
+    finally:
+        conn.close()
+
+session_store = SessionStore()
+
 # --- Client Helper ---
-_active_clients = {}
+def account_user_id(key):
+    """sess_{user_id} / profile_{user_id}_{ts} -> user_id"""
+    try:
+        return int(key.split("_")[1])
+    except (IndexError, ValueError):
+        return None
+
+class ClientPool:
+    """Ochiq Telethon klientlari: soni CLIENT_POOL_SIZE bilan cheklanadi.
+    To'lganda keyingi yuborishi eng uzoq (teng bo'lsa eng uzoq ishlatilmagan) klient uziladi,
+    tsikli ketayotgan userlarning klientlariga tegilmaydi. Har bir sessiya faylining bitta egasi bo'ladi:
+    jarayon ichida bitta klient, jarayonlar orasida .lock fayli (AuthKeyDuplicatedError oldini olish uchun)."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._clients = OrderedDict()   # key -> client, LRU tartibida
+        self._lock_files = {}           # key -> ochiq .lock fayli
+        self._key_locks = {}            # key -> asyncio.Lock (bir vaqtda ikki marta ulanmaslik uchun)
+        self._authorized_at = {}        # key -> oxirgi muvaffaqiyatli avtorizatsiya tekshiruvi (monotonic)
+        self._me = {}                   # key -> get_me() natijasi
+
+    def key_lock(self, key):
+        return self._key_locks.setdefault(key, asyncio.Lock())
+
+    def peek(self, key):
+        client = self._clients.get(key)
+        if client is not None:
+            self._clients.move_to_end(key)
+        return client
+
+    def auth_fresh(self, key):
+        checked = self._authorized_at.get(key)
+        return checked is not None and time.monotonic() - checked < CLIENT_AUTH_TTL
+
+    def mark_authorized(self, key):
+        self._authorized_at[key] = time.monotonic()
+
+    def invalidate_auth(self, key):
+        """Auth xatosi keldi - keyingi murojaatda avtorizatsiya qayta tekshiriladi"""
+        self._authorized_at.pop(key, None)
+        self._me.pop(key, None)
+
+    async def get_me(self, key, client):
+        if key not in self._me:
+            try:
+                self._me[key] = await client.get_me()
+            except UnauthorizedError:
+                self.invalidate_auth(key)
+                raise
+        return self._me[key]
+
+    def claim_session_file(self, key):
+        """Sessiya faylini boshqa jarayonlar ishlatmasligi uchun qulflash. Boshqa jarayon egalik qilsa False."""
+        if fcntl is None or key in self._lock_files:
+            return True
+        lock_file = open(f"sessions/{key}.lock", "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._lock_files[key] = lock_file
+        return True
+
+    def release_session_file(self, key):
+        lock_file = self._lock_files.pop(key, None)
+        if lock_file:
+            lock_file.close()
+
+    async def add(self, key, client):
+        """Klientni pulga qo'shish. Sessiyani boshqa jarayon egallagan bo'lsa klient uziladi va False qaytadi."""
+        old = self._clients.get(key)
+        if old is client:
+            self._clients.move_to_end(key)
+            return True
+        if not self.claim_session_file(key):
+            logging.warning(f"Session {key} is owned by another process, not adding client")
+            try:
+                await client.disconnect()
+            except Exception:
+                pass
+            return False
+        if old is not None:
+            # Bitta sessiya uchun ikkita ulanish bo'lmasligi kerak
+            try:
+                await old.disconnect()
+            except Exception:
+                pass
+        self._clients[key] = client
+        self._clients.move_to_end(key)
+        # Pulga faqat avtorizatsiyadan o'tgan klientlar qo'shiladi
+        self._me.pop(key, None)
+        self.mark_authorized(key)
+        attach_folder_cache_events(client, key)
+        attach_dialog_index_events(client, key)
+        await self._evict(keep=key)
+        return True
+
+    async def discard(self, key):
+        self.invalidate_auth(key)
+        client = self._clients.pop(key, None)
+        if client is not None:
+            try:
+                await client.disconnect()
+            except Exception:
+                pass
+        self.release_session_file(key)
+
+    def _next_send(self, key):
+        user_id = account_user_id(key)
+        delay = scheduler.next_fire_in(user_id) if user_id is not None else None
+        return float("inf") if delay is None else delay
+
+    async def _evict(self, keep=None):
+        while len(self._clients) > self.max_size:
+            candidates = [
+                (self._next_send(key), -age, key)
+                for age, key in enumerate(self._clients)
+                if key != keep and not scheduler.is_running(account_user_id(key))
+            ]
+            if not candidates:
+                logging.warning(f"Client pool over capacity ({len(self._clients)}/{self.max_size}), all clients busy")
+                return
+            _, _, victim = max(candidates)
+            logging.info(f"Evicting client {victim} from pool")
+            await self.discard(victim)
+
+    async def close(self):
+        for key in list(self._clients):
+            await self.discard(key)
+        for key in list(self._lock_files):
+            self.release_session_file(key)
+
+client_pool = ClientPool(CLIENT_POOL_SIZE)
+
+async def get_account_keys(user_id):
+    """Userning barcha akkaunt sessiya nomlari (asosiy + profillar)"""
+    profiles = await database.fetchall("SELECT session_name FROM profiles WHERE user_id = ?", (user_id,))
+    return [f"sess_{user_id}"] + [session_name for (session_name,) in profiles]
+
+async def register_client(key, client):
+    """Ulangan klientni pulga qo'shish va uning update handlerlarini ulash. Sessiya boshqa jarayonda bo'lsa False."""
+    return await client_pool.add(key, client)
 
 async def get_user_client(user_id, session_name=None):
     key = f"sess_{user_id}" if not session_name else session_name
-    
-    if key in _active_clients:
-        client = _active_clients[key]
+    async with client_pool.key_lock(key):
+        return await open_pool_client(key)
+
+async def open_pool_client(key):
+    client = client_pool.peek(key)
+    if client is not None:
         if client.is_connected():
+            # Yaqinda tekshirilgan bo'lsa Telegramga so'rov yuborilmaydi
+            if client_pool.auth_fresh(key):
+                return client
             try:
                 if await client.is_user_authorized():
+                    client_pool.mark_authorized(key)
                     return client
             except Exception:
                 pass
         # If not connected or authorized, try to clean up
-        try:
-            await client.disconnect()
-        except:
-            pass
-        del _active_clients[key]
+        await client_pool.discard(key)
 
-    session_path = f"sessions/{key}"
-    if os.path.exists(session_path + ".session"):
-        client = TelegramClient(session_path, API_ID, API_HASH)
+    if session_store.has(key):
+        if not client_pool.claim_session_file(key):
+            logging.warning(f"Session {key} is owned by another process, skipping")
+            return None
+        client = TelegramClient(await session_store.open(key), API_ID, API_HASH)
         try:
             await client.connect()
             if await client.is_user_authorized():
-                _active_clients[key] = client
+                await register_client(key, client)
                 return client
             else:
                 await client.disconnect()
         except AuthKeyDuplicatedError:
-            logging.error(f"Duplicate session for {key}. Deleting corrupted session file.")
+            logging.error(f"Duplicate session for {key}. Deleting corrupted session.")
             try: await client.disconnect() 
             except: pass
             
-            # Delete the corrupted session file
-            try:
-                if os.path.exists(session_path + ".session"):
-                    os.remove(session_path + ".session")
-                if os.path.exists(session_path + ".session-journal"):
-                    os.remove(session_path + ".session-journal")
-            except Exception as e:
-                logging.error(f"Failed to delete corrupted session {key}: {e}")
+            # Buzilgan sessiyani ombordan o'chirish
+            session_store.forget(key)
         except Exception as e:
             logging.error(f"Error connecting client {key}: {e}")
             try: await client.disconnect() 
             except: pass
+        client_pool.release_session_file(key)
             
     return None
 
+async def prewarm_user_clients(user_id):
+    """Navbatdagi tsikldan oldin userning akkauntlarini ulab qo'yish"""
+    if not scheduler.is_active(user_id):
+        return
+    for key in await get_account_keys(user_id):
+        try:
+            await get_user_client(user_id, session_name=None if key == f"sess_{user_id}" else key)
+        except Exception as e:
+            logging.error(f"Prewarm failed for {key}: {e}")
+
 def get_interval_keyboard():
     kb = [
         [InlineKeyboardButton(text="1 minut", callback_data="setint_60"), InlineKeyboardButton(text="5 minut", callback_data="setint_300")],
@@ -358,51 +1364,84 @@ def get_interval_keyboard():
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
 # --- Handlerlar ---
+START_PENDING_SUFFIX = "\n\n⏳ _Akkount ulanmoqda..._"
+_start_warmups = set()   # fondagi /start ulanish vazifalari (GC yig'ib olmasligi uchun)
+
 @dp.message(Command("start"))
 async def start_handler(message: types.Message):
     user_id = message.from_user.id
     
     # Foydalanuvchini ro'yxatga olish
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            INSERT INTO users (user_id, username, full_name, created_at)
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET 
-                username = excluded.username,
-                full_name = excluded.full_name
-        """, (user_id, message.from_user.username, message.from_user.full_name, datetime.now().isoformat()))
-        await db.commit()
-    
-    is_admin_user = await is_admin(user_id)
-    client = await get_user_client(user_id)
-    is_connected = client is not None
-    has_sub = await check_subscription(user_id)
-    
-    if not is_connected:
+    await database.execute("""
+        INSERT INTO users (user_id, username, full_name, created_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET 
+            username = excluded.username,
+            full_name = excluded.full_name
+    """, (user_id, message.from_user.username, message.from_user.full_name, datetime.now().isoformat()))
+    
+    key = f"sess_{user_id}"
+    pooled = client_pool.peek(key)
+    confirmed = pooled is not None and pooled.is_connected() and client_pool.auth_fresh(key)
+    # Sessiya fayli bo'lmasa akkaunt aniq ulanmagan - Telegramga ulanishni kutib o'tirmaymiz
+    if not confirmed and not session_store.has(key):
         await message.answer(
             "👋 Assalomu alaykum! Botdan foydalanish uchun avval profilingizni ulashingiz kerak.",
             reply_markup=await get_main_keyboard(user_id, is_connected=False)
         )
         return
-    
-    if has_sub:
-        await message.answer("🏠 **Asosiy boshqaruv paneli:**", reply_markup=await get_main_keyboard(user_id, is_connected=True), parse_mode="Markdown")
-    else:
-        # Obuna yo'q, lekin admin bo'lsa admin panel tugmasini qo'shib ko'rsatamiz
-        kb = await get_subscription_keyboard()
-        if is_admin_user:
-            # Admin uchun obuna xabari tagiga admin panel tugmasini qo'shamiz
-            new_kb = []
-            for row in kb.inline_keyboard:
-                new_kb.append(row)
-            new_kb.append([InlineKeyboardButton(text="👨‍💻 Admin Panel", callback_data="main_admin")])
-            kb = InlineKeyboardMarkup(inline_keyboard=new_kb)
-            
-        await message.answer(
-            "❌ **Sizda faol obuna mavjud emas!**\n\nBot imkoniyatlaridan foydalanish uchun obuna sotib oling:",
-            reply_markup=kb,
-            parse_mode="Markdown"
+
+    text, kb = await render_start_menu(user_id)
+    if confirmed:
+        await message.answer(text, reply_markup=kb, parse_mode="Markdown")
+        return
+
+    # Sessiya bor, lekin klient hali ulanmagan: menyuni darhol ko'rsatib, ulanishni fonda tekshiramiz
+    sent = await message.answer(text + START_PENDING_SUFFIX, reply_markup=kb, parse_mode="Markdown")
+    task = asyncio.create_task(confirm_start_menu(sent, user_id, text, kb))
+    _start_warmups.add(task)
+    task.add_done_callback(_start_warmups.discard)
+
+async def render_start_menu(user_id):
+    """Ulangan akkaunt uchun /start menyusi: (matn, klaviatura)"""
+    if await check_subscription(user_id):
+        return "🏠 **Asosiy boshqaruv paneli:**", await get_main_keyboard(user_id, is_connected=True)
+
+    # Obuna yo'q, lekin admin bo'lsa admin panel tugmasini qo'shib ko'rsatamiz
+    kb = await get_subscription_keyboard()
+    if await is_admin(user_id):
+        # Admin uchun obuna xabari tagiga admin panel tugmasini qo'shamiz
+        new_kb = []
+        for row in kb.inline_keyboard:
+            new_kb.append(row)
+        new_kb.append([InlineKeyboardButton(text="👨‍💻 Admin Panel", callback_data="main_admin")])
+        kb = InlineKeyboardMarkup(inline_keyboard=new_kb)
+    return "❌ **Sizda faol obuna mavjud emas!**\n\nBot imkoniyatlaridan foydalanish uchun obuna sotib oling:", kb
+
+async def confirm_start_menu(sent, user_id, text, kb):
+    """Fonda Telethon sessiyasini ulab, /start xabarini yakuniy holatga keltirish"""
+    try:
+        client = await get_user_client(user_id)
+    except Exception as e:
+        logging.error(f"Start warm-up failed for {user_id}: {e}")
+        client = None
+
+    try:
+        if client is not None:
+            await sent.edit_text(text, reply_markup=kb, parse_mode="Markdown")
+            return
+        # Sessiya yaroqsiz chiqdi - vaqtinchalik menyuni ulanish taklifi bilan almashtiramiz
+        try:
+            await sent.delete()
+        except Exception:
+            pass
+        await bot.send_message(
+            user_id,
+            "👋 Assalomu alaykum! Botdan foydalanish uchun avval profilingizni ulashingiz kerak.",
+            reply_markup=await get_main_keyboard(user_id, is_connected=False)
         )
+    except Exception as e:
+        logging.error(f"Failed to update start menu for {user_id}: {e}")
 
 @dp.message(F.text == "📱 Akkountga ulanish")
 async def prompt_phone(message: types.Message, state: FSMContext):
@@ -418,13 +1457,20 @@ async def process_phone(message: types.Message, state: FSMContext):
     phone = message.contact.phone_number if message.contact else message.text.replace(" ", "")
     if not phone.startswith("+"): phone = "+" + phone
     user_id = message.from_user.id
-    session_path = f"sessions/sess_{user_id}"
     await message.answer("Tekshirilmoqda...", reply_markup=types.ReplyKeyboardRemove())
-    client = TelegramClient(session_path, API_ID, API_HASH)
+    # Eski ulanish shu sessiyani ushlab turmasligi kerak
+    await client_pool.discard(f"sess_{user_id}")
+    if not client_pool.claim_session_file(f"sess_{user_id}"):
+        await message.answer("❌ Bu akkaunt hozir boshqa jarayonda ishlatilmoqda. Birozdan keyin qayta urinib ko'ring.")
+        await state.clear()
+        return
+    client = TelegramClient(await session_store.open(f"sess_{user_id}"), API_ID, API_HASH)
     try:
         await client.connect()
         sent_code = await client.send_code_request(phone)
         users_data[user_id] = {'client': client, 'phone': phone, 'is_running': False, 'ad_text': '', 'interval': DEFAULT_AD_DELAY, 'phone_code_hash': sent_code.phone_code_hash}
+        # Restartdan keyin ham kodni qabul qilish uchun FSM'da saqlanadi
+        await state.update_data(phone=phone, phone_code_hash=sent_code.phone_code_hash)
         await message.answer("📩 **Tasdiqlash kodi yuborildi.**\nKodni vergul bilan ajratib yuboring (Masalan: `1,2,3,4,5`):", parse_mode="Markdown")
         await state.set_state(AuthState.code_pass)
     except Exception as e:
@@ -437,20 +1483,30 @@ async def process_auth_step(message: types.Message, state: FSMContext):
     code = message.text.replace(",", "").replace(" ", "")
     data = await state.get_data()
     
-    if user_id not in users_data:
+    auth = users_data.get(user_id, {})
+    phone = auth.get('phone') or data.get('phone')
+    phone_code_hash = auth.get('phone_code_hash') or data.get('phone_code_hash')
+    if not phone or not phone_code_hash:
         await message.answer("❌ Xatolik: Avtorizatsiya jarayoni topilmadi. Qayta urinib ko'ring.")
         await state.clear()
         return
 
-    client = users_data[user_id]['client']
-    phone = users_data[user_id]['phone']
-    phone_code_hash = users_data[user_id]['phone_code_hash']
+    client = auth.get('client')
+    if client is None:
+        # Restartdan keyin: kod so'ralgan sessiya orqali qayta ulanamiz
+        client = TelegramClient(await session_store.open(f"sess_{user_id}"), API_ID, API_HASH)
+        await client.connect()
+        users_data.setdefault(user_id, {'is_running': False, 'ad_text': '', 'interval': DEFAULT_AD_DELAY})
+        users_data[user_id].update(client=client, phone=phone, phone_code_hash=phone_code_hash)
     saved_code = data.get('saved_code') # This is for 2FA password
 
     async def finish_auth():
-        # Clientni _active_clients ga saqlash
+        # Clientni pulga saqlash
         session_key = f"sess_{user_id}"
-        _active_clients[session_key] = client
+        if not await register_client(session_key, client):
+            await message.answer("❌ Bu akkaunt hozir boshqa jarayonda ishlatilmoqda. Birozdan keyin qayta urinib ko'ring.")
+            await state.clear()
+            return
         
         is_sub = await check_subscription(user_id)
         if is_sub:
@@ -494,9 +1550,7 @@ async def buy_subscription(callback: types.CallbackQuery, state: FSMContext):
     if not client and user_id in users_data and 'client' in users_data[user_id]:
         client = users_data[user_id]['client']
         try:
-            if client.is_connected() and await client.is_user_authorized():
-                _active_clients[f"sess_{user_id}"] = client
-            else:
+            if not (client.is_connected() and await client.is_user_authorized() and await register_client(f"sess_{user_id}", client)):
                 client = None
         except Exception:
             client = None
@@ -507,9 +1561,7 @@ async def buy_subscription(callback: types.CallbackQuery, state: FSMContext):
 
     # Narxlarni bazadan olish
     plan_key = callback.data.split("_")[1]
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT duration_days, price FROM pricing WHERE plan_type = ?", (plan_key,)) as cursor:
-            row = await cursor.fetchone()
+    row = await get_price(plan_key)
     
     if not row:
         await callback.answer("❌ Reja topilmadi!", show_alert=True)
@@ -528,9 +1580,7 @@ async def buy_subscription(callback: types.CallbackQuery, state: FSMContext):
     await state.update_data(plan_type=plan_key, plan_name=plan_name, days=days, amount=amount)
     
     # Admin panel'dan to'lov ma'lumotlarini olish
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT card_number, card_holder, amount FROM payment_info ORDER BY created_at DESC LIMIT 1") as cursor:
-            payment_row = await cursor.fetchone()
+    payment_row = await database.fetchone("SELECT card_number, card_holder, amount FROM payment_info ORDER BY created_at DESC LIMIT 1")
     
     if payment_row:
         card_number, card_holder, payment_amount = payment_row
@@ -576,9 +1626,7 @@ async def buy_pro_plan_handler(callback: types.CallbackQuery, state: FSMContext)
         return
 
     plan_key = "pro"
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT duration_days, price FROM pricing WHERE plan_type = ?", (plan_key,)) as cursor:
-            row = await cursor.fetchone()
+    row = await get_price(plan_key)
     
     if not row:
         await callback.answer("❌ Reja topilmadi!", show_alert=True)
@@ -590,9 +1638,7 @@ async def buy_pro_plan_handler(callback: types.CallbackQuery, state: FSMContext)
     await state.update_data(plan_type=plan_key, plan_name=plan_name, days=days, amount=amount)
     
     # Admin panel'dan to'lov ma'lumotlarini olish
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT card_number, card_holder, amount FROM payment_info ORDER BY created_at DESC LIMIT 1") as cursor:
-            payment_row = await cursor.fetchone()
+    payment_row = await database.fetchone("SELECT card_number, card_holder, amount FROM payment_info ORDER BY created_at DESC LIMIT 1")
     
     if payment_row:
         card_number, card_holder, payment_amount = payment_row
@@ -653,13 +1699,11 @@ async def process_payment_screenshot(message: types.Message, state: FSMContext):
     
     # To'lov so'rovini bazaga qo'shish
     request_id = None
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("""
-            INSERT INTO payment_requests (user_id, plan_type, amount, screenshot_path, status, created_at)
-            VALUES (?, ?, ?, ?, 'pending', ?)
-        """, (user_id, data.get('plan_type'), data.get('amount'), file_path, datetime.now().isoformat()))
-        request_id = cursor.lastrowid
-        await db.commit()
+    cursor = await database.execute("""
+        INSERT INTO payment_requests (user_id, plan_type, amount, screenshot_path, status, created_at)
+        VALUES (?, ?, ?, ?, 'pending', ?)
+    """, (user_id, data.get('plan_type'), data.get('amount'), file_path, datetime.now().isoformat()))
+    request_id = cursor.lastrowid
     
     # Foydalanuvchiga xabar
     await message.answer(
@@ -680,9 +1724,7 @@ async def process_payment_screenshot(message: types.Message, state: FSMContext):
         amount_fmt = str(data.get('amount', '0'))
 
     # Foydalanuvchi ma'lumotlarini olish
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT username, full_name FROM users WHERE user_id = ?", (user_id,)) as cursor:
-            user_info = await cursor.fetchone()
+    user_info = await database.fetchone("SELECT username, full_name FROM users WHERE user_id = ?", (user_id,))
     
     username = user_info[0] if user_info and user_info[0] else "Noma'lum"
     full_name = user_info[1] if user_info and user_info[1] else "Noma'lum"
@@ -705,9 +1747,7 @@ async def process_payment_screenshot(message: types.Message, state: FSMContext):
     ])
     
     # Barcha adminlarga xabar yuborish
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT admin_id FROM admins") as cursor:
-            admins = await cursor.fetchall()
+    admins = await database.fetchall("SELECT admin_id FROM admins")
             
     # Asosiy adminni ham qo'shish
     admin_ids = {ADMIN_ID}
@@ -761,9 +1801,7 @@ async def approve_payment(callback: types.CallbackQuery):
     
     # payment_requests statusni yangilash
     if request_id:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("UPDATE payment_requests SET status = 'approved' WHERE id = ?", (request_id,))
-            await db.commit()
+        await database.execute("UPDATE payment_requests SET status = 'approved' WHERE id = ?", (request_id,))
     
     # Foydalanuvchiga xabar va asosiy menyuni yuborish
     await bot.send_message(user_id, "✅ **To'lovingiz tasdiqlandi!**\n\nObunangiz faollashtirildi. Botdan foydalanishni boshlashingiz mumkin.", parse_mode="Markdown")
@@ -789,9 +1827,7 @@ async def reject_payment(callback: types.CallbackQuery):
     if len(parts) >= 4:
         request_id, user_id = int(parts[2]), int(parts[3])
         if request_id:
-            async with aiosqlite.connect(DB_PATH) as db:
-                await db.execute("UPDATE payment_requests SET status = 'rejected' WHERE id = ?", (request_id,))
-                await db.commit()
+            await database.execute("UPDATE payment_requests SET status = 'rejected' WHERE id = ?", (request_id,))
     else:
         user_id = int(parts[-1])
     
@@ -811,31 +1847,224 @@ async def cancel_payment(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
     await callback.answer()
 
-async def get_filter_dialog_ids(client, filter_obj):
-    from telethon import utils
+# --- Dialoglar Indeksi ---
+@dataclass(frozen=True)
+class DialogEntry:
+    """Akkaunt dialogining saqlanadigan qismi (iter_dialogs natijasidan)"""
+    peer_id: int
+    access_hash: Optional[int]
+    is_user: bool
+    is_group: bool
+    is_channel: bool
+    archived: bool
+    contact: bool
+    bot: bool
+    top_message: int
+
+    @classmethod
+    def from_dialog(cls, dialog):
+        entity = dialog.entity
+        return cls(
+            peer_id=dialog.id,
+            access_hash=getattr(entity, 'access_hash', None),
+            # megagroup=None bo'lishi mumkin - bazadan o'qilgan qator bilan solishtirish uchun bool
+            is_user=bool(dialog.is_user),
+            is_group=bool(dialog.is_group),
+            is_channel=bool(dialog.is_channel),
+            archived=bool(dialog.archived),
+            contact=bool(getattr(entity, 'contact', False)),
+            bot=bool(getattr(entity, 'bot', False)),
+            top_message=dialog.dialog.top_message,
+        )
+
+class DialogIndex:
+    """Har bir akkauntning dialoglari bazada (dialogs jadvali). Bir marta to'liq yig'iladi, keyin
+    faqat o'zgargan boshi so'raladi: GetDialogs oxirgi xabar sanasi bo'yicha tartiblangani uchun
+    birinchi o'zgarmagan dialogda to'xtaymiz. Chiqib ketilgan chatlar update'lardan va
+    DIALOG_FULL_SYNC_SECONDS da bir to'liq yig'ishdan tozalanadi."""
+
+    def __init__(self):
+        self._entries = {}      # account_key -> {peer_id: DialogEntry}
+        self._full_at = {}      # account_key -> oxirgi to'liq yig'ish (unix)
+        self._checked_at = {}   # account_key -> oxirgi delta tekshiruv (monotonic)
+        self._stale = set()     # yangi dialog paydo bo'lgan akkauntlar
+        self._rebuild = set()   # qo'lda to'liq qayta yig'ish so'ralgan akkauntlar
+        self._locks = {}
+
+    async def _load(self, account_key):
+        if account_key in self._entries:
+            return
+        row = await database.fetchone("SELECT full_synced_at FROM dialog_sync WHERE account_key = ?", (account_key,))
+        rows = await database.fetchall("""
+            SELECT peer_id, access_hash, is_user, is_group, is_channel, archived, contact, bot, top_message
+            FROM dialogs WHERE account_key = ?
+        """, (account_key,))
+        self._entries[account_key] = {
+            r[0]: DialogEntry(r[0], r[1], bool(r[2]), bool(r[3]), bool(r[4]), bool(r[5]), bool(r[6]), bool(r[7]), r[8])
+            for r in rows
+        }
+        self._full_at[account_key] = row[0] if row else None
+
+    async def get(self, client, account_key):
+        """Akkauntning joriy dialoglari {peer_id: DialogEntry}; kerak bo'lsa avval sinxronlanadi"""
+        lock = self._locks.setdefault(account_key, asyncio.Lock())
+        async with lock:
+            await self._load(account_key)
+            full_at = self._full_at.get(account_key)
+            if full_at is None or account_key in self._rebuild or time.time() - full_at >= DIALOG_FULL_SYNC_SECONDS:
+                await self._sync(client, account_key, full=True)
+            elif account_key in self._stale or time.monotonic() - self._checked_at.get(account_key, 0) >= DIALOG_SYNC_SECONDS:
+                await self._sync(client, account_key, full=False)
+            return self._entries[account_key]
+
+    async def _sync(self, client, account_key, full):
+        entries = self._entries[account_key]
+        self._stale.discard(account_key)
+        if full:
+            self._rebuild.discard(account_key)
+        seen = {}
+        async for dialog in client.iter_dialogs():
+            entry = DialogEntry.from_dialog(dialog)
+            # Qadalgan dialoglar sanasidan qat'i nazar boshida keladi
+            if not full and entries.get(entry.peer_id) == entry and not dialog.pinned:
+                break
+            seen[entry.peer_id] = entry
+
+        upserts = [e for peer_id, e in seen.items() if entries.get(peer_id) != e]
+        removed = [peer_id for peer_id in entries if peer_id not in seen] if full else []
+        now = int(time.time())
+
+        async def op(db):
+            if upserts:
+                await db.executemany(DIALOG_UPSERT_SQL, [dialog_row(account_key, e) for e in upserts])
+            if removed:
+                await db.executemany("DELETE FROM dialogs WHERE account_key = ? AND peer_id = ?", [(account_key, p) for p in removed])
+            if full:
+                await db.execute("INSERT OR REPLACE INTO dialog_sync (account_key, full_synced_at) VALUES (?, ?)", (account_key, now))
+        await database.transaction(op)
+
+        for e in upserts:
+            entries[e.peer_id] = e
+        for peer_id in removed:
+            del entries[peer_id]
+        if full:
+            self._full_at[account_key] = now
+        self._checked_at[account_key] = time.monotonic()
+        logging.info(f"Dialog index {'rebuilt' if full else 'synced'} for {account_key}: {len(upserts)} changed, {len(removed)} removed, {len(entries)} total")
+
+    async def refresh_peer(self, client, account_key, peer_id):
+        """Bitta chatni GetPeerDialogs bilan olib indeksga yozish. Delta bunday chatni topmasligi mumkin:
+        yangi qo'shilgan kanalning oxirgi xabari indeksdagi dialoglardan eski bo'lsa, delta undan oldin to'xtaydi.
+        Chat endi mavjud bo'lmasa indeksdan o'chiriladi; boshqa xatoda to'liq qayta yig'ish so'raladi."""
+        from telethon.tl.custom import Dialog
+        from telethon.tl.functions.messages import GetPeerDialogsRequest
+        from telethon.tl.types import InputDialogPeer
+        try:
+            input_peer = await client.get_input_entity(peer_id)
+            result = await client(GetPeerDialogsRequest(peers=[InputDialogPeer(input_peer)]))
+        except PERMANENT_SEND_ERRORS:
+            await self.remove(account_key, peer_id)
+            return
+        except Exception as e:
+            logging.warning(f"Failed to fetch dialog {peer_id} for {account_key}: {e}")
+            self.invalidate(account_key)
+            return
+
+        entities = {utils.get_peer_id(x): x for x in result.users + result.chats}
+        messages = {utils.get_peer_id(m.peer_id): m for m in result.messages}
+        found = [
+            DialogEntry.from_dialog(Dialog(client, d, entities, messages.get(utils.get_peer_id(d.peer))))
+            for d in result.dialogs
+        ]
+        if not found:
+            await self.remove(account_key, peer_id)
+            return
+        async with self._locks.setdefault(account_key, asyncio.Lock()):
+            await database.executemany(DIALOG_UPSERT_SQL, [dialog_row(account_key, e) for e in found])
+            entries = self._entries.get(account_key)
+            if entries is not None:
+                for e in found:
+                    entries[e.peer_id] = e
+        # Papka keshi shu chat bilan qayta yig'ilishi uchun
+        invalidate_folder_cache(account_key)
+        logging.info(f"Dialog {peer_id} added to index for {account_key}")
+
+    def invalidate(self, account_key):
+        """Keyingi murojaatda to'liq qayta yig'ish"""
+        self._rebuild.add(account_key)
+
+    def note_message(self, account_key, peer_id):
+        """Notanish chatdan xabar keldi - keyingi murojaatda delta so'raladi.
+        Ma'lum chatlarning top_message'i bu yerda o'zgartirilmaydi: delta faqat bazadagi qator
+        bilan bir xil dialogda to'xtashi kerak, aks holda undan pastdagi yangi chatlar o'tkazib yuboriladi."""
+        entries = self._entries.get(account_key)
+        if entries is not None and peer_id not in entries:
+            self._stale.add(account_key)
+
+    async def remove(self, account_key, peer_id):
+        entries = self._entries.get(account_key)
+        if entries is not None:
+            entries.pop(peer_id, None)
+        await database.execute("DELETE FROM dialogs WHERE account_key = ? AND peer_id = ?", (account_key, peer_id))
+
+DIALOG_UPSERT_SQL = """
+    INSERT OR REPLACE INTO dialogs (account_key, peer_id, access_hash, is_user, is_group, is_channel, archived, contact, bot, top_message)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+def dialog_row(account_key, e):
+    return (account_key, e.peer_id, e.access_hash, e.is_user, e.is_group, e.is_channel, e.archived, e.contact, e.bot, e.top_message)
+
+dialog_index = DialogIndex()
+
+def attach_dialog_index_events(client, account_key):
+    """Yangi chatlar va chiqib ketilgan chatlar bo'yicha indeksni yangilash"""
+
+    async def on_new_message(event):
+        dialog_index.note_message(account_key, event.chat_id)
+
+    async def on_chat_action(event):
+        if event.created:
+            await dialog_index.refresh_peer(client, account_key, event.chat_id)
+            return
+        if not (event.user_left or event.user_kicked or event.user_joined or event.user_added):
+            return
+        me = await client.get_me(input_peer=True)
+        if not me or me.user_id not in event.user_ids:
+            return
+        if event.user_left or event.user_kicked:
+            await dialog_index.remove(account_key, event.chat_id)
+        else:
+            await dialog_index.refresh_peer(client, account_key, event.chat_id)
+
+    async def on_channel_update(event):
+        # Kanalga qo'shilish (join xabari bo'lmasa ham), chiqarilish yoki huquqlar o'zgarishi
+        await dialog_index.refresh_peer(client, account_key, utils.get_peer_id(PeerChannel(event.channel_id)))
+
+    client.add_event_handler(on_new_message, events.NewMessage())
+    client.add_event_handler(on_chat_action, events.ChatAction())
+    client.add_event_handler(on_channel_update, events.Raw(types=[UpdateChannel]))
+
+async def get_filter_dialogs(client, account_key, filter_obj):
+    """Papkaga tushadigan dialoglar: {dialog_id: access_hash}"""
     inc_peers = set(utils.get_peer_id(p) for p in getattr(filter_obj, 'include_peers', []))
     exc_peers = set(utils.get_peer_id(p) for p in getattr(filter_obj, 'exclude_peers', []))
     
-    found_ids = []
-    async for dialog in client.iter_dialogs():
-        entity = dialog.entity
+    found = {}
+    for peer_id, dialog in (await dialog_index.get(client, account_key)).items():
         if getattr(filter_obj, 'exclude_archived', False) and dialog.archived:
             continue
             
-        if not entity:
-            continue
-            
-        peer_id = utils.get_peer_id(entity)
         if peer_id in exc_peers:
             continue
             
         if peer_id in inc_peers:
-            found_ids.append(str(dialog.id))
+            found[peer_id] = dialog.access_hash
             continue
             
-        is_contact = dialog.is_user and getattr(entity, 'contact', False)
-        is_non_contact = dialog.is_user and not getattr(entity, 'contact', False) and not getattr(entity, 'bot', False)
-        is_bot = dialog.is_user and getattr(entity, 'bot', False)
+        is_contact = dialog.is_user and dialog.contact
+        is_non_contact = dialog.is_user and not dialog.contact and not dialog.bot
+        is_bot = dialog.is_user and dialog.bot
         is_group = dialog.is_group
         is_broadcast = dialog.is_channel and not dialog.is_group
         
@@ -844,9 +2073,70 @@ async def get_filter_dialog_ids(client, filter_obj):
            (getattr(filter_obj, 'bots', False) and is_bot) or \
            (getattr(filter_obj, 'groups', False) and is_group) or \
            (getattr(filter_obj, 'broadcasts', False) and is_broadcast):
-            found_ids.append(str(dialog.id))
+            found[peer_id] = dialog.access_hash
             
-    return list(set(found_ids))
+    return found
+
+# --- Folder Maqsadlari Keshi ---
+# (account_key, papka nomi) -> (amal qilish muddati, chat IDlari)
+_folder_cache = {}
+
+def folder_title(filter_obj):
+    """Papka nomi (yangi layerlarda title TextWithEntities bo'ladi)"""
+    title = getattr(filter_obj, 'title', None)
+    return getattr(title, 'text', title)
+
+def invalidate_folder_cache(account_key):
+    for cache_key in [k for k in _folder_cache if k[0] == account_key]:
+        del _folder_cache[cache_key]
+
+async def get_folder_targets(client, account_key, folder_names):
+    """Akkauntning berilgan papkalaridagi chat IDlari. Natija TTL bilan keshlanadi."""
+    now = time.monotonic()
+    targets = set()
+    missing = []
+    for name in folder_names:
+        entry = _folder_cache.get((account_key, name))
+        if entry and entry[0] > now:
+            targets.update(entry[1])
+        else:
+            missing.append(name)
+    
+    if missing:
+        from telethon.tl.functions.messages import GetDialogFiltersRequest
+        filters = await client(GetDialogFiltersRequest())
+        expires_at = time.monotonic() + FOLDER_CACHE_TTL
+        for f in filters:
+            title = folder_title(f)
+            if title and title.lower() in missing:
+                # Barcha dialog turlarini qo'shish (chat, group, channel, bot, user)
+                ids = frozenset(await get_filter_dialogs(client, account_key, f))
+                _folder_cache[(account_key, title.lower())] = (expires_at, ids)
+                targets.update(ids)
+        # Telegramda topilmagan papkalar ham keshlanadi, har tsiklda qayta so'ralmasligi uchun
+        for name in missing:
+            _folder_cache.setdefault((account_key, name), (expires_at, frozenset()))
+    
+    return targets
+
+def attach_folder_cache_events(client, account_key):
+    """Papkalar o'zgarsa yoki yangi chatga qo'shilsak keshni tozalash"""
+    from telethon.tl.types import UpdateDialogFilter, UpdateDialogFilters, UpdateDialogFilterOrder
+
+    async def on_filters_changed(event):
+        logging.info(f"Dialog filters changed for {account_key}, invalidating folder cache")
+        invalidate_folder_cache(account_key)
+
+    async def on_chat_action(event):
+        if event.created:
+            invalidate_folder_cache(account_key)
+        elif event.user_joined or event.user_added:
+            me = await client.get_me(input_peer=True)
+            if me and me.user_id in event.user_ids:
+                invalidate_folder_cache(account_key)
+
+    client.add_event_handler(on_filters_changed, events.Raw(types=[UpdateDialogFilter, UpdateDialogFilters, UpdateDialogFilterOrder]))
+    client.add_event_handler(on_chat_action, events.ChatAction())
 
 # --- Profillar Tizimi ---
 @dp.callback_query(F.data == "main_profillar")
@@ -859,9 +2149,7 @@ async def show_profiles(callback: types.CallbackQuery):
         await callback.answer("❌ Bu xizmat faqat obuna bo'lgan foydalanuvchilar uchun!", show_alert=True)
         return await send_sub_msg(callback.message)
     
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT id, phone, is_active FROM profiles WHERE user_id = ?", (user_id,)) as cursor:
-            profiles = await cursor.fetchall()
+    profiles = await database.fetchall("SELECT id, phone, is_active FROM profiles WHERE user_id = ?", (user_id,))
     
     text = "👥 **Sizning Profillaringiz**\n\n"
     
@@ -897,10 +2185,9 @@ async def process_add_profile_phone(message: types.Message, state: FSMContext):
     
     user_id = message.from_user.id
     session_name = f"profile_{user_id}_{int(datetime.now().timestamp())}"
-    session_path = f"sessions/{session_name}"
     
     await message.answer("🔍 **Tekshirilmoqda...**", reply_markup=types.ReplyKeyboardRemove(), parse_mode="Markdown")
-    client = TelegramClient(session_path, API_ID, API_HASH)
+    client = TelegramClient(await session_store.open(session_name), API_ID, API_HASH)
     
     try:
         await client.connect()
@@ -945,19 +2232,17 @@ async def process_add_profile_code(message: types.Message, state: FSMContext):
     if user_id in users_data and temp_key in users_data[user_id]:
         client = users_data[user_id][temp_key]
     else:
-        session_path = f"sessions/{session_name}"
-        client = TelegramClient(session_path, API_ID, API_HASH)
+        client = TelegramClient(await session_store.open(session_name), API_ID, API_HASH)
         await client.connect()
         if user_id not in users_data: users_data[user_id] = {}
         users_data[user_id][temp_key] = client
 
     async def finish_auth():
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("""
-                INSERT INTO profiles (user_id, phone, session_name, created_at)
-                VALUES (?, ?, ?, ?)
-            """, (user_id, phone, session_name, datetime.now().isoformat()))
-            await db.commit()
+        await database.execute("""
+            INSERT INTO profiles (user_id, phone, session_name, created_at)
+            VALUES (?, ?, ?, ?)
+        """, (user_id, phone, session_name, datetime.now().isoformat()))
+        stats.bump(stats.profiles, user_id)
         await message.answer(f"✅ **Profil qo'shildi:** `{phone}`", parse_mode="Markdown")
         try: await client.disconnect()
         except: pass
@@ -996,6 +2281,74 @@ async def process_add_profile_code(message: types.Message, state: FSMContext):
             await state.clear()
 
 # --- Guruhlar Tizimi ---
+GROUP_TARGETS_PAGE = 1000
+
+async def save_group_folder(user_id, folder_name, targets=None):
+    """Folderni yaratish (bo'lmasa) va chatlarini sinxronlash. targets: {target_id: access_hash} yoki None.
+    Faqat farq yoziladi: yangi chatlar qo'shiladi, folderdan chiqqanlari o'chiriladi. (qo'shildi, o'chirildi) qaytadi."""
+    async def op(db):
+        cursor = await db.execute(
+            "INSERT INTO groups (user_id, folder_name, created_at) VALUES (?, ?, ?) ON CONFLICT(user_id, folder_name) DO NOTHING",
+            (user_id, folder_name, datetime.now().isoformat())
+        )
+        created = cursor.rowcount > 0
+        async with db.execute("SELECT id FROM groups WHERE user_id = ? AND folder_name = ?", (user_id, folder_name)) as cursor:
+            folder_id = (await cursor.fetchone())[0]
+        if targets is None:
+            return created, 0, 0
+        
+        async with db.execute("SELECT target_id FROM group_targets WHERE folder_id = ?", (folder_id,)) as cursor:
+            existing = {row[0] for row in await cursor.fetchall()}
+        now = int(time.time())
+        added = [(user_id, folder_id, t, h, now) for t, h in targets.items() if t not in existing]
+        removed = [(folder_id, t) for t in existing if t not in targets]
+        if added:
+            await db.executemany(
+                "INSERT INTO group_targets (user_id, folder_id, target_id, access_hash, added_at) VALUES (?, ?, ?, ?, ?)",
+                added
+            )
+        if removed:
+            await db.executemany("DELETE FROM group_targets WHERE folder_id = ? AND target_id = ?", removed)
+        return created, len(added), len(removed)
+    
+    created, added, removed = await database.transaction(op)
+    if created:
+        stats.bump(stats.groups, user_id)
+    if added or removed:
+        logging.info(f"Folder '{folder_name}' of {user_id}: +{added} / -{removed} targets")
+    return added, removed
+
+async def delete_group_folder(group_id):
+    async def op(db):
+        async with db.execute("SELECT user_id FROM groups WHERE id = ?", (group_id,)) as cursor:
+            row = await cursor.fetchone()
+        await db.execute("DELETE FROM group_targets WHERE folder_id = ?", (group_id,))
+        await db.execute("DELETE FROM groups WHERE id = ?", (group_id,))
+        return row[0] if row else None
+    owner = await database.transaction(op)
+    if owner is not None:
+        stats.bump(stats.groups, owner, -1)
+
+async def iter_group_targets(user_id):
+    """Foydalanuvchi folderlaridagi chat IDlari, bazadan sahifalab (keyset) o'qiladi"""
+    last_id = None
+    while True:
+        if last_id is None:
+            rows = await database.fetchall(
+                "SELECT DISTINCT target_id FROM group_targets WHERE user_id = ? ORDER BY target_id LIMIT ?",
+                (user_id, GROUP_TARGETS_PAGE)
+            )
+        else:
+            rows = await database.fetchall(
+                "SELECT DISTINCT target_id FROM group_targets WHERE user_id = ? AND target_id > ? ORDER BY target_id LIMIT ?",
+                (user_id, last_id, GROUP_TARGETS_PAGE)
+            )
+        for (target_id,) in rows:
+            yield target_id
+        if len(rows) < GROUP_TARGETS_PAGE:
+            return
+        last_id = rows[-1][0]
+
 @dp.callback_query(F.data == "main_groups")
 async def show_groups(callback: types.CallbackQuery):
     user_id = callback.from_user.id
@@ -1006,35 +2359,77 @@ async def show_groups(callback: types.CallbackQuery):
         await callback.answer("❌ Bu xizmat faqat obuna bo'lgan foydalanuvchilar uchun!", show_alert=True)
         return await send_sub_msg(callback.message)
     
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT id, folder_name, group_ids FROM groups WHERE user_id = ?", (user_id,)) as cursor:
-            groups = await cursor.fetchall()
+    groups = await database.fetchall("""
+        SELECT g.id, g.folder_name, COUNT(t.target_id) FROM groups g
+        LEFT JOIN group_targets t ON t.folder_id = g.id
+        WHERE g.user_id = ? GROUP BY g.id ORDER BY g.id
+    """, (user_id,))
+    quarantined = target_quarantine.entries_for(await get_account_keys(user_id))
     
     text = "📋 **Guruh Folderlar**\n\n"
     
     if not groups:
         text += "Hozircha folder yo'q.\n\n"
     else:
-        for idx, (gid, folder_name, group_ids) in enumerate(groups, 1):
-            count = len(group_ids.split(",")) if group_ids else 0
+        for idx, (gid, folder_name, count) in enumerate(groups, 1):
             text += f"{idx}. 📁 {folder_name} ({count} guruh)\n"
     
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🆕 Yangi folder ochish", callback_data="create_group_folder")],
         [InlineKeyboardButton(text="📥 Mavjud folderni qo'shish", callback_data="import_group_folder")],
         [InlineKeyboardButton(text="🗑 Folder o'chirish", callback_data="delete_group")],
+        [InlineKeyboardButton(text="🔄 Chatlarni yangilash", callback_data="refresh_group_targets")],
+        [InlineKeyboardButton(text=f"🚫 Karantin ({len(quarantined)})", callback_data="show_quarantine")],
         [InlineKeyboardButton(text="🔙 Orqaga", callback_data="main_profile")]
     ])
     
     await callback.message.answer(text, reply_markup=kb, parse_mode="Markdown")
     await callback.answer()
 
+@dp.callback_query(F.data == "show_quarantine")
+async def show_quarantine(callback: types.CallbackQuery):
+    """Yuborib bo'lmayotgan (karantindagi) chatlar ro'yxati"""
+    user_id = callback.from_user.id
+    entries = target_quarantine.entries_for(await get_account_keys(user_id))
+    
+    text = "🚫 **Karantindagi chatlar**\n\n"
+    if not entries:
+        text += "Karantinda chat yo'q."
+    else:
+        text += "Bu chatlarga yuborib bo'lmadi, ular vaqti-vaqti bilan qayta tekshiriladi:\n\n"
+        for account, target_id, failures, error, next_probe_at in entries[:30]:
+            probe = datetime.fromtimestamp(next_probe_at).strftime("%Y-%m-%d %H:%M")
+            text += f"🔸 `{target_id}` — {error} ({failures} marta), tekshiruv: {probe}\n"
+        if len(entries) > 30:
+            text += f"\n... va yana {len(entries) - 30} ta"
+    
+    kb = []
+    if entries:
+        kb.append([InlineKeyboardButton(text="♻️ Hammasini qayta sinash", callback_data="release_quarantine")])
+    kb.append([InlineKeyboardButton(text="🔙 Orqaga", callback_data="main_groups")])
+    await callback.message.answer(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=kb), parse_mode="Markdown")
+    await callback.answer()
+
+@dp.callback_query(F.data == "release_quarantine")
+async def release_quarantine(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    await target_quarantine.release(await get_account_keys(user_id))
+    await callback.answer("✅ Chatlar keyingi tsiklda qayta sinab ko'riladi!", show_alert=True)
+
+@dp.callback_query(F.data == "refresh_group_targets")
+async def refresh_group_targets(callback: types.CallbackQuery):
+    """Papkalardagi chatlar keshini tozalash - keyingi tsiklda Telegramdan qayta yig'iladi"""
+    user_id = callback.from_user.id
+    for account_key in await get_account_keys(user_id):
+        invalidate_folder_cache(account_key)
+        dialog_index.invalidate(account_key)
+    
+    await callback.answer("✅ Chatlar ro'yxati keyingi tsiklda yangilanadi!", show_alert=True)
+
 @dp.callback_query(F.data == "delete_group")
 async def delete_group_prompt(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT id, folder_name FROM groups WHERE user_id = ?", (user_id,)) as cursor:
-            groups = await cursor.fetchall()
+    groups = await database.fetchall("SELECT id, folder_name FROM groups WHERE user_id = ?", (user_id,))
     
     if not groups:
         await callback.answer("❌ O'chirish uchun folder yo'q!", show_alert=True)
@@ -1051,9 +2446,7 @@ async def delete_group_prompt(callback: types.CallbackQuery, state: FSMContext):
 @dp.callback_query(F.data.startswith("del_g_"))
 async def process_delete_group(callback: types.CallbackQuery):
     group_id = int(callback.data.split("_")[-1])
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM groups WHERE id = ?", (group_id,))
-        await db.commit()
+    await delete_group_folder(group_id)
     await callback.answer("✅ Folder o'chirildi!")
     await show_groups(callback)
 
@@ -1107,12 +2500,7 @@ async def process_create_folder_name(message: types.Message, state: FSMContext):
         ))
         
         # Add to database
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("""
-                INSERT INTO groups (user_id, folder_name, group_ids, created_at)
-                VALUES (?, ?, ?, ?)
-            """, (user_id, folder_name, "", datetime.now().isoformat()))
-            await db.commit()
+        await save_group_folder(user_id, folder_name)
             
         await message.answer(
             f"✅ Telegramda **{folder_name}** nomli yangi papka yaratildi va botga qo'shildi!\n\n"
@@ -1177,17 +2565,9 @@ async def process_import_folder_select(callback: types.CallbackQuery):
         folder_name = target_filter.title
         await callback.message.edit_text(f"🔄 **{folder_name}** papkasidagi chatlar yig'ilmoqda...")
         
-        found_groups = await get_filter_dialog_ids(client, target_filter)
-        
-        group_ids = ",".join(found_groups)
+        found_groups = await get_filter_dialogs(client, f"sess_{user_id}", target_filter)
         
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("""
-                INSERT INTO groups (user_id, folder_name, group_ids, created_at)
-                VALUES (?, ?, ?, ?)
-                ON CONFLICT(user_id, folder_name) DO UPDATE SET group_ids = excluded.group_ids
-            """, (user_id, folder_name, group_ids, datetime.now().isoformat()))
-            await db.commit()
+        await save_group_folder(user_id, folder_name, found_groups)
         
         await callback.message.edit_text(
             f"✅ Folder muvaffaqiyatli qo'shildi: **{folder_name}**\n\n"
@@ -1212,7 +2592,7 @@ async def process_group_name(message: types.Message, state: FSMContext):
     
     # Telegram folders check
     client = await get_user_client(user_id)
-    found_groups = []
+    found_groups = {}
     available_folders = []
     if client:
         try:
@@ -1223,19 +2603,13 @@ async def process_group_name(message: types.Message, state: FSMContext):
                     available_folders.append(f.title)
                     if f.title.lower() == folder_name.lower():
                         # Barcha dialog turlarini qo'shish (chat, group, channel, bot, user)
-                        found_groups = await get_filter_dialog_ids(client, f)
+                        found_groups = await get_filter_dialogs(client, f"sess_{user_id}", f)
                         break
         except Exception as e:
             logging.error(f"Sync error: {e}")
 
-    group_ids = ",".join(found_groups)
-    
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            INSERT INTO groups (user_id, folder_name, group_ids, created_at)
-            VALUES (?, ?, ?, ?)
-        """, (user_id, folder_name, group_ids, datetime.now().isoformat()))
-        await db.commit()
+    # Papka topilmasa mavjud chatlarga tegilmaydi - IDlar keyingi qadamda so'raladi
+    await save_group_folder(user_id, folder_name, found_groups or None)
     
     if found_groups:
         await message.answer(
@@ -1262,22 +2636,22 @@ async def process_group_ids(message: types.Message, state: FSMContext):
     data = await state.get_data()
     folder_name = data.get('current_folder_name')
     
-    ids = []
+    ids = {}
     if message.text == "/all":
         client = await get_user_client(user_id)
         if client:
             await message.answer("🔄 Barcha chat/guruh/kanallar yig'ilmoqda, kuting...")
             # Barcha dialog turlarini qo'shish
-            async for dialog in client.iter_dialogs():
-                ids.append(str(dialog.id))
+            for peer_id, dialog in (await dialog_index.get(client, f"sess_{user_id}")).items():
+                ids[peer_id] = dialog.access_hash
     else:
-        ids = [i.strip() for i in message.text.split("\n") if i.strip()]
+        for i in message.text.split("\n"):
+            try:
+                ids[int(i.strip())] = None
+            except ValueError:
+                continue
 
-    group_ids = ",".join(ids)
-    
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE groups SET group_ids = ? WHERE user_id = ? AND folder_name = ?", (group_ids, user_id, folder_name))
-        await db.commit()
+    await save_group_folder(user_id, folder_name, ids)
     
     await message.answer(f"✅ {len(ids)} ta chat/guruh/kanal saqlandi!", reply_markup=await get_main_keyboard(user_id, is_connected=True))
     await state.clear()
@@ -1316,22 +2690,22 @@ async def save_ad_text(message: types.Message, state: FSMContext):
         voice_path = f"payments/ad_{user_id}_voice.ogg"
         await bot.download_file(file.file_path, voice_path)
 
+    invalidate_media_cache(user_id)
+    await compile_ad(user_id, ad_text, image_path, video_path, voice_path)
     users_data[user_id]['ad_text'] = ad_text
     users_data[user_id]['image_path'] = image_path
     users_data[user_id]['video_path'] = video_path
     users_data[user_id]['voice_path'] = voice_path
     
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            INSERT INTO user_settings (user_id, ad_text, interval, image_path, video_path, voice_path)
-            VALUES (?, ?, ?, ?, ?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET 
-                ad_text = excluded.ad_text,
-                image_path = excluded.image_path,
-                video_path = excluded.video_path,
-                voice_path = excluded.voice_path
-        """, (user_id, ad_text, users_data[user_id].get('interval', DEFAULT_AD_DELAY), image_path, video_path, voice_path))
-        await db.commit()
+    await database.execute("""
+        INSERT INTO user_settings (user_id, ad_text, interval, image_path, video_path, voice_path)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET 
+            ad_text = excluded.ad_text,
+            image_path = excluded.image_path,
+            video_path = excluded.video_path,
+            voice_path = excluded.voice_path
+    """, (user_id, ad_text, users_data[user_id].get('interval', DEFAULT_AD_DELAY), image_path, video_path, voice_path))
     
     await message.answer("✅ Reklama xabari saqlandi!", reply_markup=await get_main_keyboard(user_id, is_connected=True))
     await state.clear()
@@ -1378,13 +2752,11 @@ async def process_custom_interval(message: types.Message, state: FSMContext):
             users_data[user_id] = {'is_running': False, 'ad_text': ''}
         users_data[user_id]['interval'] = seconds
         
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("""
-                INSERT INTO user_settings (user_id, interval, ad_text)
-                VALUES (?, ?, ?)
-                ON CONFLICT(user_id) DO UPDATE SET interval = excluded.interval
-            """, (user_id, seconds, users_data[user_id].get('ad_text', '')))
-            await db.commit()
+        await database.execute("""
+            INSERT INTO user_settings (user_id, interval, ad_text)
+            VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET interval = excluded.interval
+        """, (user_id, seconds, users_data[user_id].get('ad_text', '')))
         
         await message.answer(f"✅ Interval **{seconds} sekund** qilib belgilandi!", reply_markup=await get_main_keyboard(user_id, is_connected=True), parse_mode="Markdown")
         await state.clear()
@@ -1404,25 +2776,600 @@ async def start_sender_handler(callback: types.CallbackQuery):
         await callback.answer("⚠️ Sender allaqachon ishlamoqda.", show_alert=True)
         return
     
-    users_data[user_id]['is_running'] = True
+    # Ishlab turgan senderlar muddati tugaganda subscription_sweeper to'xtatadi
+    if not await check_subscription(user_id):
+        await callback.answer("❌ Obunangiz tugagan!", show_alert=True)
+        return await send_sub_msg(callback.message)
     
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE user_settings SET is_running = 1 WHERE user_id = ?", (user_id,))
-        await db.commit()
-
-    asyncio.create_task(start_sender(user_id))
+    if not users_data[user_id].get('ad'):
+        data = users_data[user_id]
+        await compile_ad(user_id, data['ad_text'], data.get('image_path'), data.get('video_path'), data.get('voice_path'))
+    
+    await set_sender_running(user_id, True)
+    scheduler.schedule(user_id)
     await callback.message.answer("🚀 Reklama tarqatish boshlandi!")
     await callback.answer()
 
 
-async def start_sender(user_id):
-    """Reklama yuborish tsikli"""
-    logging.info(f"Starting sender for user {user_id}")
+# --- Yuborish tezligini cheklash ---
+class RateLimiter:
+    """Akkaunt uchun token-bucket: rate (minutiga xabar), burst va FloodWait pauzalari"""
+
+    def __init__(self, rate, burst):
+        self.configure(rate, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.chat_paused_until = {}
+        self.avg_send_time = None
+
+    def configure(self, rate, burst):
+        self.rate = max(rate, 0.01) / 60
+        self.burst = max(int(burst), 1)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    def wait_time(self):
+        """Keyingi xabargacha kutish kerak bo'lgan soniyalar"""
+        now = self._refill()
+        wait = max(self.paused_until - now, 0)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    async def acquire(self):
+        """Token bo'shaguncha kutadi (sender to'xtatilsa task bekor qilinadi)"""
+        while True:
+            wait = self.wait_time()
+            if wait <= 0:
+                self.tokens -= 1
+                return
+            await asyncio.sleep(wait)
+
+    def record_send(self, seconds):
+        """Muvaffaqiyatli yuborish davomiyligi (o'rtacha qiymat yangilanadi)"""
+        if self.avg_send_time is None:
+            self.avg_send_time = seconds
+        else:
+            self.avg_send_time = 0.8 * self.avg_send_time + 0.2 * seconds
+
+    def throughput(self):
+        """O'lchangan tezlik (xabar/soniya): limit va haqiqiy yuborish vaqtining kichigi"""
+        if self.avg_send_time:
+            return min(self.rate, 1 / self.avg_send_time)
+        return self.rate
+
+    def refund(self):
+        """Muvaffaqiyatsiz yuborishdan keyin tokenni qaytarish"""
+        self._refill()
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def pause(self, seconds):
+        """FloodWaitError: butun akkauntni to'xtatib turish"""
+        until = time.monotonic() + seconds
+        self.paused_until = max(self.paused_until, until)
+
+    def pause_chat(self, chat_id, seconds):
+        """SlowModeWaitError: faqat bitta chatni to'xtatib turish"""
+        self.chat_paused_until[chat_id] = time.monotonic() + seconds
+
+    def is_chat_paused(self, chat_id):
+        until = self.chat_paused_until.get(chat_id)
+        if until is None:
+            return False
+        if until <= time.monotonic():
+            del self.chat_paused_until[chat_id]
+            return False
+        return True
+
+_rate_limiters = {}
+
+def get_rate_limiter(account_key, plan_type=None):
+    """Akkaunt uchun limiterni olish (reja o'zgarsa limitlar yangilanadi)"""
+    rate, burst = PLAN_SEND_LIMITS.get(plan_type, (SEND_RATE, SEND_BURST))
+    limiter = _rate_limiters.get(account_key)
+    if limiter is None:
+        limiter = RateLimiter(rate, burst)
+        _rate_limiters[account_key] = limiter
+    else:
+        limiter.configure(rate, burst)
+    return limiter
+
+async def get_plan_type(user_id):
+    return access_cache.get(user_id)[1]
+
+# --- Ishlamaydigan Chatlar Karantini ---
+PERMANENT_SEND_ERRORS = (
+    ChatWriteForbiddenError, ChannelPrivateError, UserBannedInChannelError, ChatAdminRequiredError,
+    ChatRestrictedError, ChannelInvalidError, ChatIdInvalidError, PeerIdInvalidError,
+    InputUserDeactivatedError, UserIsBlockedError,
+)
+
+class TargetNotFoundError(Exception):
+    """Chatni akkaunt uchun aniqlab bo'lmadi (o'chirilgan yoki a'zo emasmiz)"""
+
+def is_permanent_send_error(error):
+    return isinstance(error, PERMANENT_SEND_ERRORS + (TargetNotFoundError,))
+
+class TargetQuarantine:
+    """(akkaunt, chat) bo'yicha doimiy xatolarni kuzatadi va ishlamaydigan chatlarni karantinga oladi"""
+
+    def __init__(self):
+        self._failures = {}   # (account, target_id) -> karantingacha bo'lgan ketma-ket xatolar
+        self._entries = {}    # (account, target_id) -> (failures, error, next_probe_at)
+
+    async def load(self):
+        rows = await database.fetchall("SELECT account, target_id, failures, error, next_probe_at FROM quarantine")
+        self._entries = {(account, target_id): (failures, error, next_probe_at) for account, target_id, failures, error, next_probe_at in rows}
+
+    def is_blocked(self, account, target_id):
+        entry = self._entries.get((account, target_id))
+        return entry is not None and entry[2] > time.time()
+
+    def filter(self, account, targets):
+        """Karantindagi chatlarni chiqarib tashlash (qayta tekshirish vaqti kelganlari qoladi)"""
+        return [t for t in targets if not self.is_blocked(account, t)]
+
+    async def record_failure(self, account, target_id, error):
+        key = (account, target_id)
+        if key in self._entries:
+            failures = self._entries[key][0] + 1
+        else:
+            failures = self._failures.get(key, 0) + 1
+            if failures < QUARANTINE_THRESHOLD:
+                self._failures[key] = failures
+                return
+            self._failures.pop(key, None)
+        
+        # Har bir muvaffaqiyatsiz tekshiruvdan keyin kutish ikki baravar oshadi
+        delay = min(QUARANTINE_BASE_SECONDS * 2 ** (failures - QUARANTINE_THRESHOLD), QUARANTINE_MAX_SECONDS)
+        entry = (failures, type(error).__name__, int(time.time() + delay))
+        self._entries[key] = entry
+        await database.execute(
+            "INSERT OR REPLACE INTO quarantine (account, target_id, failures, error, next_probe_at) VALUES (?, ?, ?, ?, ?)",
+            (account, target_id, *entry)
+        )
+        logging.info(f"Target {target_id} quarantined for {account} ({entry[1]}, retry in {delay}s)")
+
+    async def record_success(self, account, target_id):
+        key = (account, target_id)
+        self._failures.pop(key, None)
+        if self._entries.pop(key, None):
+            await database.execute("DELETE FROM quarantine WHERE account = ? AND target_id = ?", key)
+
+    def entries_for(self, accounts):
+        accounts = set(accounts)
+        return sorted(
+            [(account, target_id, *entry) for (account, target_id), entry in self._entries.items() if account in accounts],
+            key=lambda e: e[4]
+        )
+
+    async def release(self, accounts):
+        """Akkauntlarning barcha chatlarini karantindan chiqarish"""
+        accounts = list(accounts)
+        for key in [k for k in self._entries if k[0] in accounts]:
+            del self._entries[key]
+        await database.executemany("DELETE FROM quarantine WHERE account = ?", [(a,) for a in accounts])
+
+target_quarantine = TargetQuarantine()
+
+async def paced_send(client, user_id, account_key, limiter, target_id, data):
+    """Limiter orqali yuborish. Holat: 'sent', 'failed', 'skipped' (slow mode) yoki 'flood' (akkaunt uzoq bloklandi)."""
+    if limiter.is_chat_paused(target_id):
+        logging.info(f"Skipping {target_id}: slow mode is still active")
+        delivery_log.record(user_id, account_key, target_id, 'skipped', 0, "SlowModeWaitError")
+        return 'skipped'
+    
+    # Qisqa FloodWait'dan keyin pauzani kutib shu chatga qayta urinamiz;
+    # faqat FLOOD_HANDOFF_SECONDS dan uzun blokda chatlar boshqa akkauntlarga o'tadi
+    while True:
+        await limiter.acquire()
+        started = time.monotonic()
+        try:
+            await send_ad(client, account_key, target_id, data['ad'])
+            elapsed = time.monotonic() - started
+            limiter.record_send(elapsed)
+            delivery_log.record(user_id, account_key, target_id, 'sent', elapsed)
+            await target_quarantine.record_success(account_key, target_id)
+            return 'sent'
+        except FloodWaitError as e:
+            logging.warning(f"FloodWait {e.seconds}s on {account_key} while sending to {target_id}")
+            delivery_log.record(user_id, account_key, target_id, 'flood', time.monotonic() - started, f"FloodWaitError({e.seconds})")
+            limiter.pause(e.seconds)
+            if e.seconds > FLOOD_HANDOFF_SECONDS:
+                return 'flood'
+        except SlowModeWaitError as e:
+            logging.warning(f"Slow mode {e.seconds}s in {target_id}")
+            delivery_log.record(user_id, account_key, target_id, 'skipped', time.monotonic() - started, f"SlowModeWaitError({e.seconds})")
+            limiter.pause_chat(target_id, e.seconds)
+            limiter.refund()
+            return 'skipped'
+        except Exception as e:
+            logging.warning(f"Failed to send to {target_id} from {account_key}: {e}")
+            if isinstance(e, UnauthorizedError):
+                client_pool.invalidate_auth(account_key)
+            delivery_log.record(user_id, account_key, target_id, 'failed', time.monotonic() - started, type(e).__name__)
+            if is_permanent_send_error(e):
+                await target_quarantine.record_failure(account_key, target_id, e)
+            limiter.refund()
+            return 'failed'
+
+# --- Tayyorlangan Reklama ---
+@dataclass(frozen=True)
+class CompiledAd:
+    """Saqlash paytida bir marta tayyorlangan, o'zgarmas reklama"""
+    version: int
+    text: str
+    entities: tuple
+    media_kind: Optional[str] = None
+    media_path: Optional[str] = None
+    media_hash: Optional[str] = None
+
+_ad_versions = itertools.count(1)
+
+def media_digest(path):
+    """Fayl mazmunining sha256 hashi"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+async def compile_ad(user_id, ad_text, image_path=None, video_path=None, voice_path=None):
+    """Reklamani tayyorlab users_data ga joylash. Ishlayotgan sender keyingi yuborishdan yangi versiyaga o'tadi."""
+    media_kind, media_path, media_hash = None, None, None
+    for kind, path in (("image", image_path), ("video", video_path), ("voice", voice_path)):
+        if path and os.path.exists(path):
+            media_kind, media_path = kind, path
+            media_hash = await asyncio.to_thread(media_digest, path)
+            break
+    
+    # Markdown bir marta parse qilinadi, Telethon har yuborishda qayta parse qilmaydi
+    text, entities = markdown.parse(ad_text or "")
+    ad = CompiledAd(
+        version=next(_ad_versions),
+        text=text,
+        entities=tuple(entities),
+        media_kind=media_kind,
+        media_path=media_path,
+        media_hash=media_hash
+    )
+    users_data.setdefault(user_id, {})['ad'] = ad
+    return ad
+
+# --- Yuklangan Media Keshi ---
+# (account_key, fayl hash) -> yuklangan InputFile, birinchi yuborishdan keyin esa serverdagi InputMedia
+_media_cache = {}
+
+def invalidate_media_cache(user_id):
+    """Userning barcha akkauntlari uchun yuklangan media keshini tozalash"""
+    prefixes = (f"sess_{user_id}", f"profile_{user_id}_")
+    for cache_key in [k for k in _media_cache if k[0] == prefixes[0] or k[0].startswith(prefixes[1])]:
+        del _media_cache[cache_key]
+
+async def send_cached_media(client, account_key, peer, ad):
+    """Media faylni akkaunt uchun bir marta yuklab, keyingi chatlarga qayta ishlatish"""
+    cache_key = (account_key, ad.media_hash)
+    media = _media_cache.get(cache_key)
+    if media is None:
+        media = await client.upload_file(ad.media_path)
+        _media_cache[cache_key] = media
+    
+    try:
+        msg = await client.send_file(peer, media, caption=ad.text, formatting_entities=list(ad.entities))
+    except FileReferenceExpiredError:
+        # Server havolasi eskirgan - faylni qayta yuklaymiz
+        media = await client.upload_file(ad.media_path)
+        _media_cache[cache_key] = media
+        msg = await client.send_file(peer, media, caption=ad.text, formatting_entities=list(ad.entities))
+    
+    # Keyingi yuborishlar uchun serverdagi media havolasini saqlash
+    if msg and msg.media:
+        try:
+            _media_cache[cache_key] = utils.get_input_media(msg.media)
+        except TypeError:
+            pass
+
+async def send_ad(client, account_key, target_id, ad):
+    """Bitta chatga tayyor reklamani yuborish"""
+    # Chatni aniqlash alohida bosqich: faqat shu yerdagi ValueError doimiy xato hisoblanadi
+    try:
+        peer = await client.get_input_entity(target_id)
+    except ValueError as e:
+        raise TargetNotFoundError(str(e)) from e
+    if ad.media_path:
+        await send_cached_media(client, account_key, peer, ad)
+    else:
+        await client.send_message(peer, ad.text, formatting_entities=list(ad.entities))
+
+async def collect_account_targets(client, account_key, user_folders, manual_targets):
+    """Bitta akkaunt uchun yuboriladigan chat IDlari"""
+    # Jo'natilishi kerak bo'lgan IDlar
+    final_target_ids = set()
+    dialogs = await dialog_index.get(client, account_key)
+
+    if user_folders:
+        # 1. Folderlarga saqlangan IDlar (group_targets) - faqat akkaunt a'zo bo'lganlari,
+        # aks holda planner chatni a'zo bo'lmagan akkauntga biriktirishi mumkin
+        final_target_ids.update(t for t in manual_targets if t in dialogs)
+
+        # 2. Telegram papkalarini tekshirish (keshdan)
+        try:
+            final_target_ids.update(await get_folder_targets(client, account_key, user_folders))
+        except Exception as e:
+            logging.error(f"Error getting DialogFilters: {e}")
+
+    if not final_target_ids and not manual_targets:
+        # Agar folderlar aniqlanmagan bo'lsa, barcha guruhlarga yuboradi
+        for peer_id, dialog in dialogs.items():
+            if dialog.is_group or dialog.is_channel:
+                final_target_ids.add(peer_id)
+    
+    return list(final_target_ids)
+
+async def send_from_account(client, user_id, account_key, limiter, data, planner, outbox):
+    """Bitta akkaunt worker'i: planner biriktirgan chatlarga yuboradi. Yuborilganlar sonini qaytaradi.
+    O'z navbati bo'shasa ham boshqa akkauntlar tugaguncha kutadi - ulardan qaytgan chatlarni oladi."""
+    sent = 0
+    try:
+        while data.get('is_running'):
+            target_id = await planner.next_target(account_key)
+            if target_id is None:
+                break
+            
+            status = await paced_send(client, user_id, account_key, limiter, target_id, data)
+            if status == 'flood':
+                # Akkaunt uzoq muddatga bloklandi - qolgan chatlari boshqa akkauntlarga o'tadi
+                moved = planner.release(account_key)
+                moved.append((target_id, planner.reassign(target_id, account_key)))
+                await planner.done(account_key)
+                for moved_id, new_account in moved:
+                    if new_account is None:
+                        await outbox.mark(moved_id, account_key, 'failed')
+                logging.info(f"{account_key} handed off {len(moved)} targets after FloodWait")
+                break
+            # Chat boshqa akkauntga o'tkazilgach in-flight tugaydi, shunda kutayotgan worker uni ko'radi
+            reassigned = status == 'failed' and planner.reassign(target_id, account_key)
+            await planner.done(account_key)
+            if reassigned:
+                # Boshqa akkaunt urinib ko'radi va holatni o'zi yozadi
+                continue
+            
+            await outbox.mark(target_id, account_key, 'sent' if status == 'sent' else 'failed')
+            if status == 'sent':
+                sent += 1
+    finally:
+        await planner.leave(account_key)
+    return sent
+
+# --- Chatlarni Akkauntlar Bo'yicha Taqsimlash ---
+class TargetPlanner:
+    """Har bir chatni unga a'zo akkauntlardan faqat bittasiga biriktiradi (tezlik va FloodWait hisobga olinadi)"""
+
+    def __init__(self, membership, limiters, preferred=None):
+        self.limiters = limiters
+        self.queues = {account: deque() for account in membership}
+        self.active = set(membership)
+        self.in_flight = set()  # hozir yuborayotgan akkauntlar
+        self._changed = asyncio.Condition()
+        self.candidates = {}   # target_id -> [account, ...]
+        self.tried = {}        # target_id -> urinib ko'rgan akkauntlar
+        for account, targets in membership.items():
+            for target_id in targets:
+                self.candidates.setdefault(target_id, []).append(account)
+        
+        preferred = preferred or {}
+        # Kam akkauntga ega chatlar birinchi taqsimlanadi
+        for target_id in sorted(self.candidates, key=lambda t: len(self.candidates[t])):
+            account = preferred.get(target_id)
+            if account not in self.candidates[target_id]:
+                account = min(self.candidates[target_id], key=self._cost)
+            self.queues[account].append(target_id)
+
+    def _cost(self, account):
+        """Akkaunt yana bitta chatni qachon tugatishi (soniya)"""
+        limiter = self.limiters[account]
+        return limiter.wait_time() + (len(self.queues[account]) + 1) / limiter.throughput()
+
+    def assignment(self):
+        return {account: list(queue) for account, queue in self.queues.items()}
+
+    def _busy(self):
+        """Biror faol akkauntda navbat yoki yuborilayotgan chat bormi"""
+        return bool(self.in_flight) or any(self.queues[a] for a in self.active)
+
+    async def next_target(self, account):
+        """Navbatdagi chat. Navbat bo'sh bo'lsa boshqalar tugashini kutadi (reassign qilingan chat kelishi mumkin).
+        Hech kimda ish qolmasa None."""
+        async with self._changed:
+            while account in self.active:
+                queue = self.queues[account]
+                if queue:
+                    target_id = queue.popleft()
+                    self.tried.setdefault(target_id, set()).add(account)
+                    self.in_flight.add(account)
+                    return target_id
+                if not self._busy():
+                    self._changed.notify_all()
+                    return None
+                await self._changed.wait()
+            return None
+
+    async def done(self, account):
+        """Yuborish tugadi (natija reassign/release bilan qayta ishlangandan keyin chaqiriladi)"""
+        async with self._changed:
+            self.in_flight.discard(account)
+            self._changed.notify_all()
+
+    async def leave(self, account):
+        """Worker chiqdi - unga boshqa chat berilmaydi"""
+        async with self._changed:
+            self.active.discard(account)
+            self.in_flight.discard(account)
+            self._changed.notify_all()
+
+    def reassign(self, target_id, failed_account):
+        """Chatni hali urinmagan faol akkauntga o'tkazish. Yangi akkaunt yoki None qaytaradi."""
+        tried = self.tried.get(target_id, set())
+        options = [a for a in self.candidates.get(target_id, []) if a != failed_account and a not in tried and a in self.active]
+        if not options:
+            return None
+        account = min(options, key=self._cost)
+        self.queues[account].append(target_id)
+        return account
+
+    def release(self, account):
+        """Akkaunt ishdan chiqdi - navbatidagi chatlarni boshqalarga o'tkazish"""
+        self.active.discard(account)
+        queue = self.queues[account]
+        moved = []
+        while queue:
+            target_id = queue.popleft()
+            moved.append((target_id, self.reassign(target_id, account)))
+        return moved
+
+# --- Yetkazish Jurnali ---
+class DeliveryLog:
+    """Har bir yuborish natijasi xotiradagi halqa buferga yoziladi va fonda partiyalab bazaga tushadi"""
+
+    def __init__(self, batch_size, flush_seconds, capacity):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self._buffer = deque(maxlen=capacity)
+        self._flush_needed = asyncio.Event()
+
+    def record(self, user_id, account, target_id, status, latency, error=None):
+        """Sender kutmaydi - faqat buferga qo'shiladi"""
+        self._buffer.append((int(time.time()), user_id, account, target_id, status, int(latency * 1000), error))
+        if len(self._buffer) >= self.batch_size:
+            self._flush_needed.set()
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        rows = []
+        while self._buffer:
+            rows.append(self._buffer.popleft())
+        await database.executemany(
+            "INSERT INTO deliveries (created_at, user_id, account, target_id, status, latency_ms, error) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Error flushing delivery log: {e}")
+
+    async def cleanup(self, retention_days):
+        """Eski yozuvlarni o'chirish"""
+        cutoff = int(time.time()) - retention_days * 86400
+        cursor = await database.execute("DELETE FROM deliveries WHERE created_at < ?", (cutoff,))
+        if cursor.rowcount:
+            logging.info(f"Delivery log cleanup removed {cursor.rowcount} rows")
+
+delivery_log = DeliveryLog(DELIVERY_LOG_BATCH, DELIVERY_LOG_FLUSH_SECONDS, DELIVERY_LOG_CAPACITY)
+
+async def delivery_log_retention():
+    while True:
+        try:
+            await delivery_log.cleanup(DELIVERY_LOG_RETENTION_DAYS)
+        except Exception as e:
+            logging.error(f"Error cleaning delivery log: {e}")
+        await asyncio.sleep(3600)
+
+# --- Yetkazish Navbati (Outbox) ---
+class CycleOutbox:
+    """Tsikl rejasi va yuborish holatlari. Holatlar bazaga partiyalab yoziladi."""
+
+    def __init__(self, user_id, cycle_id):
+        self.user_id = user_id
+        self.cycle_id = cycle_id
+        self._updates = []
+
+    async def mark(self, target_id, account, state):
+        self._updates.append((state, account, self.user_id, self.cycle_id, target_id))
+        if len(self._updates) >= OUTBOX_BATCH:
+            await self.flush()
+
+    async def flush(self):
+        if not self._updates:
+            return
+        updates, self._updates = self._updates, []
+        await database.executemany(
+            "UPDATE outbox SET state = ?, account = ? WHERE user_id = ? AND cycle_id = ? AND target_id = ?",
+            updates
+        )
+
+    async def finish(self):
+        """Tsikl tugadi - uning yozuvlari o'chiriladi, jadval kichik qoladi"""
+        self._updates = []
+        await database.execute("DELETE FROM outbox WHERE user_id = ? AND cycle_id = ?", (self.user_id, self.cycle_id))
+
+async def create_cycle_outbox(user_id, plan, candidates):
+    """Yangi tsikl rejasini ({account: [target_id, ...]}) bazaga yozish.
+    candidates ({target_id: [account, ...]}) ham saqlanadi - resume'da chat faqat a'zo akkauntlarga o'tkaziladi."""
+    outbox = CycleOutbox(user_id, int(time.time() * 1000))
+    rows = [
+        (user_id, outbox.cycle_id, account, target_id, ",".join(candidates.get(target_id, [account])))
+        for account, targets in plan.items() for target_id in targets
+    ]
+    await database.executemany(
+        "INSERT OR IGNORE INTO outbox (user_id, cycle_id, account, target_id, state, candidates) VALUES (?, ?, ?, ?, 'pending', ?)",
+        rows
+    )
+    return outbox
+
+async def load_pending_cycle(user_id):
+    """Restartdan oldin tugallanmagan tsikl: (CycleOutbox, {account: [target_id, ...]}, {target_id: account}) yoki None.
+    Birinchi lug'at - a'zolik (saqlangan candidates), ikkinchisi - avvalgi biriktirish."""
+    row = await database.fetchone("SELECT cycle_id FROM outbox WHERE user_id = ? AND state = 'pending' ORDER BY cycle_id LIMIT 1", (user_id,))
+    if not row:
+        return None
+    cycle_id = row[0]
+    rows = await database.fetchall("SELECT account, target_id, candidates FROM outbox WHERE user_id = ? AND cycle_id = ? AND state = 'pending' ORDER BY rowid", (user_id, cycle_id))
+    
+    membership = {}
+    preferred = {}
+    for account, target_id, candidates in rows:
+        preferred[target_id] = account
+        # candidates'siz eski yozuvlarda a'zolik noma'lum - chat faqat o'z akkauntida qoladi
+        for candidate in candidates.split(",") if candidates else [account]:
+            membership.setdefault(candidate, []).append(target_id)
+    return CycleOutbox(user_id, cycle_id), membership, preferred
+
+async def discard_outbox(user_id):
+    """Sender to'xtatilganda tugallanmagan tsiklni bekor qilish"""
+    await database.execute("DELETE FROM outbox WHERE user_id = ?", (user_id,))
+
+async def set_sender_running(user_id, is_running):
+    """Sender holatini xotirada va bazada yangilash"""
+    if user_id in users_data:
+        users_data[user_id]['is_running'] = is_running
+    cursor = await database.execute("UPDATE user_settings SET is_running = ? WHERE user_id = ?", (1 if is_running else 0, user_id))
+    if cursor.rowcount:
+        stats.set_running(user_id, is_running)
+
+async def run_send_cycle(user_id):
+    """Reklama yuborish tsikli. Keyingi tsiklgacha soniyalarni qaytaradi (None - sender to'xtadi)."""
     try:
         data = users_data[user_id]
     except KeyError:
         logging.error(f"User data not found for {user_id}")
-        return
+        return None
+    
+    if not data.get('is_running'):
+        return None
     
     # Barcha faol klientlarni yig'ish
     clients = []
@@ -1430,138 +3377,294 @@ async def start_sender(user_id):
     # 1. Asosiy klient
     c_main = await get_user_client(user_id)
     if c_main:
-        clients.append(c_main)
+        clients.append((f"sess_{user_id}", c_main))
             
     # 2. Qo'shimcha profillar
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT session_name FROM profiles WHERE user_id = ? AND is_active = 1", (user_id,)) as cursor:
-            profiles_db = await cursor.fetchall()
+    profiles_db = await database.fetchall("SELECT session_name FROM profiles WHERE user_id = ? AND is_active = 1", (user_id,))
             
     for (session_name,) in profiles_db:
         c_prof = await get_user_client(user_id, session_name=session_name)
         if c_prof:
-            clients.append(c_prof)
+            clients.append((session_name, c_prof))
                 
     if not clients:
-        data['is_running'] = False
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("UPDATE user_settings SET is_running = 0 WHERE user_id = ?", (user_id,))
-            await db.commit()
+        await set_sender_running(user_id, False)
         await bot.send_message(user_id, "❌ Hech qanday faol Telegram akkaunt topilmadi! Iltimos, akkauntingizni qaytadan ulang.")
-        return
+        return None
 
     # Guruhlarni bazadan olish
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT folder_name, group_ids FROM groups WHERE user_id = ?", (user_id,)) as cursor:
-            rows = await cursor.fetchall()
-            user_folders = [r[0].lower() for r in rows]
-            manual_group_ids = {}
-            for row in rows:
-                if row[1]:
-                    manual_group_ids[row[0].lower()] = [int(gid) for gid in row[1].split(",") if gid]
-
-    await bot.send_message(user_id, f"🔍 Guruhlar tahlil qilinmoqda ({len(clients)} akkaunt)...")
-
-    while data.get('is_running'):
-        if not await check_subscription(user_id):
-            data['is_running'] = False
-            async with aiosqlite.connect(DB_PATH) as db:
-                await db.execute("UPDATE user_settings SET is_running = 0 WHERE user_id = ?", (user_id,))
-                await db.commit()
-            await bot.send_message(user_id, "❌ Obunangiz tugadi! Xizmat to'xtatildi.")
-            break
-            
-        try:
-            total_sent = 0
-            for client in clients:
-                if not data.get('is_running'): break
-                
-                # Jo'natilishi kerak bo'lgan IDlar
-                final_target_ids = set()
+    rows = await database.fetchall("SELECT folder_name FROM groups WHERE user_id = ?", (user_id,))
+    user_folders = [r[0].lower() for r in rows]
+    manual_targets = [target_id async for target_id in iter_group_targets(user_id)] if user_folders else []
 
-                if user_folders:
-                    # 1. Manual saqlangan IDlarni qo'shish
-                    for folder, ids in manual_group_ids.items():
-                        final_target_ids.update(ids)
+    if not data.get('cycles'):
+        await bot.send_message(user_id, f"🔍 Guruhlar tahlil qilinmoqda ({len(clients)} akkaunt)...")
+    data['cycles'] = data.get('cycles', 0) + 1
 
-                    # 2. Telegram papkalarini tekshirish
-                    try:
-                        from telethon.tl.functions.messages import GetDialogFiltersRequest
-                        filters = await client(GetDialogFiltersRequest())
-                        for f in filters:
-                            if hasattr(f, 'title') and f.title.lower() in user_folders:
-                                # Barcha dialog turlarini qo'shish (chat, group, channel, bot, user)
-                                for _d_id in await get_filter_dialog_ids(client, f):
-                                    final_target_ids.add(int(_d_id))
-                    except Exception as e:
-                        logging.error(f"Error getting DialogFilters: {e}")
-
-                if final_target_ids:
-                    for target_id in final_target_ids:
-                        if not data.get('is_running'): break
-                        try:
-                            # Media yuborishni tekshirish
-                            media_file = None
-                            if data.get('image_path') and os.path.exists(data['image_path']):
-                                media_file = data['image_path']
-                            elif data.get('video_path') and os.path.exists(data['video_path']):
-                                media_file = data['video_path']
-                            elif data.get('voice_path') and os.path.exists(data['voice_path']):
-                                media_file = data['voice_path']
-
-                            if media_file:
-                                await client.send_file(target_id, media_file, caption=data.get('ad_text', ''))
-                            else:
-                                await client.send_message(target_id, data.get('ad_text', ''))
-                            
-                            total_sent += 1
-                            await asyncio.sleep(15)
-                        except Exception as e:
-                            logging.warning(f"Failed to send to {target_id}: {e}")
-                else:
-                    # Agar folderlar aniqlanmagan bo'lsa, barcha guruhlarga yuboradi
-                    async for dialog in client.iter_dialogs():
-                        if not data.get('is_running'): break
-                        if dialog.is_group or dialog.is_channel:
-                            try:
-                                # Media yuborishni tekshirish
-                                media_file = None
-                                if data.get('image_path') and os.path.exists(data['image_path']):
-                                    media_file = data['image_path']
-                                elif data.get('video_path') and os.path.exists(data['video_path']):
-                                    media_file = data['video_path']
-                                elif data.get('voice_path') and os.path.exists(data['voice_path']):
-                                    media_file = data['voice_path']
-
-                                if media_file:
-                                    await client.send_file(dialog.id, media_file, caption=data.get('ad_text', ''))
-                                else:
-                                    await client.send_message(dialog.id, data.get('ad_text', ''))
-                                
-                                total_sent += 1
-                                await asyncio.sleep(15)
-                            except Exception as e:
-                                logging.warning(f"Failed to send to {dialog.id}: {e}")
+    interval = data.get('interval') or DEFAULT_AD_DELAY
+    outbox = None
+    try:
+        plan_type = await get_plan_type(user_id)
+        limiters = {key: get_rate_limiter(key, plan_type) for key, client in clients}
+        
+        # Restartdan oldin tugallanmagan tsikl bo'lsa, qolgan chatlardan davom etamiz
+        pending = await load_pending_cycle(user_id)
+        if pending:
+            outbox, membership, preferred = pending
+            logging.info(f"Resuming cycle {outbox.cycle_id} for {user_id}: {len(preferred)} targets left")
+            # Avvalgi biriktirish saqlanadi; chat faqat unga a'zo ulangan akkauntlar orasida qayta taqsimlanadi
+            planner = TargetPlanner(
+                {key: target_quarantine.filter(key, membership.get(key, [])) for key, client in clients},
+                limiters, preferred
+            )
+        else:
+            targets = await asyncio.gather(
+                *[collect_account_targets(client, key, user_folders, manual_targets) for key, client in clients],
+                return_exceptions=True
+            )
+            membership = {}
+            for (key, client), result in zip(clients, targets):
+                if isinstance(result, Exception):
+                    logging.error(f"Failed to collect targets for {key}: {result}")
+                    continue
+                # Karantindagi chatlarga budjet sarflanmaydi
+                membership[key] = target_quarantine.filter(key, result)
+            # Har bir chat faqat bitta akkauntga biriktiriladi
+            planner = TargetPlanner(membership, limiters)
+            outbox = await create_cycle_outbox(user_id, planner.assignment(), planner.candidates)
+        
+        # Har bir akkaunt alohida parallel worker sifatida ishlaydi
+        results = await asyncio.gather(
+            *[send_from_account(client, user_id, key, limiters[key], data, planner, outbox) for key, client in clients if key in planner.queues],
+            return_exceptions=True
+        )
+        await outbox.finish()
+        total_sent = 0
+        for result in results:
+            if isinstance(result, Exception):
+                logging.error(f"Account worker failed for user {user_id}: {result}")
+                continue
+            total_sent += result
+        
+        if total_sent == 0:
+            await bot.send_message(user_id, "⚠️ Hech qanday guruh topilmadi. Folderlaringizni tekshiring.")
+            await set_sender_running(user_id, False)
+            return None
+
+        await bot.send_message(user_id, f"✅ Reklama tarqatish tsikli tugadi. **{total_sent}** ta guruhga yuborildi.\n⏱ Navbatdagi tsikl {interval} soniyadan keyin boshlanadi.", parse_mode="Markdown")
+        logging.info(f"Cycle finished for {user_id}. Sent: {total_sent}. Waiting {interval} seconds.")
+        return interval
             
-            if total_sent == 0:
-                await bot.send_message(user_id, "⚠️ Hech qanday guruh topilmadi. Folderlaringizni tekshiring.")
-                data['is_running'] = False
-                async with aiosqlite.connect(DB_PATH) as db:
-                    await db.execute("UPDATE user_settings SET is_running = 0 WHERE user_id = ?", (user_id,))
-                    await db.commit()
-                break
+    except Exception as e:
+        logging.error(f"Error in send cycle for {user_id}: {e}")
+        return 60
+    finally:
+        # To'xtatilsa yoki xato bo'lsa ham yuborilganlar yozib qo'yiladi
+        if outbox:
+            await outbox.flush()
+
+# --- Sender Rejalashtiruvchisi ---
+class SenderScheduler:
+    """Barcha senderlar uchun yagona rejalashtiruvchi: (next_fire, user_id) heap.
+    Har bir tsikl o'z taskida ishlaydi - soatlab davom etadigan tsikl boshqa userlarni kutdirmaydi."""
+
+    def __init__(self):
+        self._heap = []
+        self._next_fire = {}   # user_id -> joriy rejalashtirilgan vaqt (heapdagi eski yozuvlar e'tiborsiz qoladi)
+        self._running = {}     # user_id -> hozir ishlayotgan tsikl taski
+        self._cancelled = set()  # bekor qilingan, lekin finally'si hali tugamagan tsikllar
+        self._restart = {}     # user_id -> (delay, prewarm): bekor qilingan tsikl tugagach qayta rejalashtirish
+        self._prewarm_timers = {}  # user_id -> call_later handle
+        self._prewarm_tasks = set()
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+
+    def start(self):
+        self._dispatcher = asyncio.create_task(self._dispatch_loop())
+
+    def schedule(self, user_id, delay=0, prewarm=True):
+        """Userning keyingi tsiklini delay soniyadan keyin rejalashtirish"""
+        if user_id in self._running:
+            # To'xtatilgan tsikl hali yakunlanmoqda - tugashi bilan rejalashtiriladi
+            if user_id in self._cancelled:
+                self._restart[user_id] = (delay, prewarm)
+            return
+        fire_at = time.monotonic() + delay
+        self._next_fire[user_id] = fire_at
+        heapq.heappush(self._heap, (fire_at, user_id))
+        self._wakeup.set()
+        # Pul to'lganda uzilgan akkauntlar tsikldan biroz oldin qayta ulanadi
+        self._cancel_prewarm(user_id)
+        if prewarm and delay > CLIENT_PREWARM_SECONDS:
+            self._prewarm_timers[user_id] = asyncio.get_running_loop().call_later(
+                delay - CLIENT_PREWARM_SECONDS, self._start_prewarm, user_id
+            )
 
-            if total_sent > 0:
-                await bot.send_message(user_id, f"✅ Reklama tarqatish tsikli tugadi. **{total_sent}** ta guruhga yuborildi.\n⏱ Navbatdagi tsikl {data['interval']} soniyadan keyin boshlanadi.", parse_mode="Markdown")
+    def _start_prewarm(self, user_id):
+        self._prewarm_timers.pop(user_id, None)
+        task = asyncio.create_task(prewarm_user_clients(user_id))
+        self._prewarm_tasks.add(task)
+        task.add_done_callback(self._prewarm_tasks.discard)
+
+    def _cancel_prewarm(self, user_id):
+        timer = self._prewarm_timers.pop(user_id, None)
+        if timer:
+            timer.cancel()
+
+    def cancel(self, user_id):
+        """Senderni darhol to'xtatish (rejalashtirilgan va ishlayotgan tsikl)"""
+        self._next_fire.pop(user_id, None)
+        self._restart.pop(user_id, None)
+        self._cancel_prewarm(user_id)
+        task = self._running.get(user_id)
+        if task:
+            self._cancelled.add(user_id)
+            task.cancel()
+
+    async def stop(self):
+        """Yangi tsikllarni to'xtatish va ishlayotganlarini bekor qilib, outbox flush'ini kutish.
+        users_data va bazadagi is_running o'zgarmaydi - restartdan keyin senderlar davom etadi."""
+        if self._dispatcher:
+            self._dispatcher.cancel()
+        self._next_fire.clear()
+        self._restart.clear()
+        for user_id in list(self._prewarm_timers):
+            self._cancel_prewarm(user_id)
+        tasks = list(self._running.values()) + list(self._prewarm_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def is_active(self, user_id):
+        return user_id in self._next_fire or user_id in self._running
+
+    def is_running(self, user_id):
+        return user_id in self._running
+
+    def next_fire_in(self, user_id):
+        """Keyingi tsiklgacha soniya (hozir ishlayotgan bo'lsa 0, rejalashtirilmagan bo'lsa None)"""
+        if user_id in self._running:
+            return 0
+        fire_at = self._next_fire.get(user_id)
+        return None if fire_at is None else max(0, fire_at - time.monotonic())
+
+    async def _dispatch_loop(self):
+        while True:
+            now = time.monotonic()
+            while self._heap and self._heap[0][0] <= now:
+                fire_at, user_id = heapq.heappop(self._heap)
+                if self._next_fire.get(user_id) != fire_at:
+                    continue
+                del self._next_fire[user_id]
+                self._launch(user_id)
+            
+            timeout = self._heap[0][0] - now if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
 
-            logging.info(f"Cycle finished for {user_id}. Sent: {total_sent}. Waiting {data['interval']} seconds.")
-            for _ in range(data['interval']):
-                if not data.get('is_running'): break
-                await asyncio.sleep(1)
-                
+    def _launch(self, user_id):
+        task = asyncio.create_task(run_send_cycle(user_id))
+        self._running[user_id] = task
+        task.add_done_callback(lambda t: self._cycle_done(user_id, t))
+
+    def _cycle_done(self, user_id, task):
+        self._running.pop(user_id, None)
+        self._cancelled.discard(user_id)
+        restart = self._restart.pop(user_id, None)
+        if restart is not None:
+            # Tsikl yakunlanayotganda sender qayta yoqilgan
+            self.schedule(user_id, *restart)
+            return
+        
+        if task.cancelled():
+            logging.info(f"Sender cancelled for user {user_id}")
+            return
+        if task.exception():
+            logging.error(f"Send cycle crashed for user {user_id}: {task.exception()}")
+            next_delay = 60
+        else:
+            next_delay = task.result()
+        
+        if next_delay is not None and users_data.get(user_id, {}).get('is_running'):
+            self.schedule(user_id, next_delay)
+
+scheduler = SenderScheduler()
+
+# --- Obuna Muddati Nazorati ---
+async def stop_sender(user_id, notice=None):
+    """Senderni to'xtatish va tugallanmagan tsiklni bekor qilish. Sender ishlab turgan bo'lsa True."""
+    was_running = bool(users_data.get(user_id, {}).get('is_running'))
+    if not was_running and not scheduler.is_active(user_id):
+        # Ishlamayapti va rejada ham yo'q - bazaga yozadigan narsa yo'q
+        return False
+    await set_sender_running(user_id, False)
+    scheduler.cancel(user_id)
+    await discard_outbox(user_id)
+    if not was_running:
+        return False
+    if notice:
+        try:
+            await bot.send_message(user_id, notice)
         except Exception as e:
-            logging.error(f"Error in start_sender loop: {e}")
-            await asyncio.sleep(60)
+            logging.error(f"Failed to notify {user_id}: {e}")
+    return True
+
+class SubscriptionSweeper:
+    """Muddati tugagan obunalarning senderlarini to'xtatadi.
+    Oxirgi tekshiruvdan beri tugaganlar expiry_ts indeksi bo'yicha oraliq so'rovi bilan topiladi,
+    keyin eng yaqin muddatgacha (SUBSCRIPTION_SWEEP_MAX_SECONDS dan oshmasdan) uxlanadi."""
+
+    def __init__(self):
+        # Boot vaqtidan: restartgacha tugagan obunalarni resume_senders o'zi o'tkazib yuboradi
+        self.last_checked = int(time.time())
+        self._wake = asyncio.Event()
+
+    def wake(self):
+        """Obuna o'zgardi - keyingi muddat qayta hisoblanadi"""
+        self._wake.set()
+
+    async def sweep(self):
+        now = int(time.time())
+        rows = await database.fetchall(
+            "SELECT user_id FROM subscriptions WHERE expiry_ts > ? AND expiry_ts <= ?",
+            (self.last_checked, now)
+        )
+        self.last_checked = now
+        stopped = 0
+        for (user_id,) in rows:
+            # Shu orada uzaytirilgan bo'lishi mumkin
+            if await check_subscription(user_id):
+                continue
+            if await stop_sender(user_id, "❌ Obunangiz tugadi! Xizmat to'xtatildi."):
+                stopped += 1
+        if stopped:
+            logging.info(f"Subscription sweep stopped {stopped} senders")
+
+    async def next_expiry(self):
+        row = await database.fetchone("SELECT MIN(expiry_ts) FROM subscriptions WHERE expiry_ts > ?", (self.last_checked,))
+        return row[0] if row else None
+
+    async def run(self):
+        while True:
+            try:
+                await self.sweep()
+                next_ts = await self.next_expiry()
+            except Exception as e:
+                logging.error(f"Subscription sweep failed: {e}")
+                next_ts = None
+            delay = SUBSCRIPTION_SWEEP_MAX_SECONDS
+            if next_ts is not None:
+                delay = min(delay, max(1, next_ts - time.time()))
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+subscription_sweeper = SubscriptionSweeper()
 
 # --- Profil va Sozlamalar ---
 @dp.callback_query(F.data == "main_profile")
@@ -1571,13 +3674,11 @@ async def show_profile(callback: types.CallbackQuery):
     me = None
     if client:
         try:
-            me = await client.get_me()
+            me = await client_pool.get_me(f"sess_{user_id}", client)
         except Exception as e:
             logging.error(f"Error getting user info: {e}")
     
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT expiry_date FROM subscriptions WHERE user_id = ?", (user_id,)) as cursor:
-            row = await cursor.fetchone()
+    row = await database.fetchone("SELECT expiry_date FROM subscriptions WHERE user_id = ?", (user_id,))
     
     expiry = row[0] if row else "Obuna yo'q"
     
@@ -1590,9 +3691,7 @@ async def show_profile(callback: types.CallbackQuery):
         display_username = f"@{me.username}" if me.username else "yo'q"
     else:
         # Avval users jadvalidan tekshirish
-        async with aiosqlite.connect(DB_PATH) as db:
-            async with db.execute("SELECT full_name, username FROM users WHERE user_id = ?", (user_id,)) as cur:
-                urow = await cur.fetchone()
+        urow = await database.fetchone("SELECT full_name, username FROM users WHERE user_id = ?", (user_id,))
         
         if urow and urow[0]:
             display_name = urow[0]
@@ -1636,9 +3735,7 @@ async def user_extend_sub(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
     await state.update_data(extend_user_id=user_id)
     
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT plan_type, duration_days, price FROM pricing ORDER BY duration_days") as cursor:
-            prices = await cursor.fetchall()
+    prices = await get_prices()
     plan_btn = {"start": "extend_buy_start", "3month": "extend_buy_3month", "pro": "extend_buy_pro", "year": "extend_buy_year", "vip": "extend_buy_vip"}
     plan_names = {"start": "Start — 1 oy", "3month": "Pro — 3 oy", "pro": "Pro — 6 oy", "year": "VIP — 1 yil", "vip": "VIP — Umrbod"}
     kb = []
@@ -1661,9 +3758,7 @@ async def extend_buy_subscription(callback: types.CallbackQuery, state: FSMConte
         return
 
     plan_key = callback.data.split("_")[2]
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT duration_days, price FROM pricing WHERE plan_type = ?", (plan_key,)) as cursor:
-            row = await cursor.fetchone()
+    row = await get_price(plan_key)
     
     if not row:
         await callback.answer("❌ Reja topilmadi!", show_alert=True)
@@ -1704,24 +3799,15 @@ async def extend_buy_subscription(callback: types.CallbackQuery, state: FSMConte
 async def stop_sender_handler(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     if user_id in users_data:
-        users_data[user_id]['is_running'] = False
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("UPDATE user_settings SET is_running = 0 WHERE user_id = ?", (user_id,))
-            await db.commit()
+        await stop_sender(user_id)
         await callback.message.answer("✅ Sender to'xtatildi!")
     await callback.answer()
 
 @dp.callback_query(F.data == "main_logout")
 async def logout(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    client = await get_user_client(user_id)
-    if client:
-        await client.disconnect()
-    
-    for ext in [".session", ".session-journal"]:
-        path = f"sessions/sess_{user_id}{ext}"
-        if os.path.exists(path):
-            os.remove(path)
+    await client_pool.discard(f"sess_{user_id}")
+    session_store.forget(f"sess_{user_id}")
     
     if user_id in users_data:
         del users_data[user_id]
@@ -1767,11 +3853,8 @@ async def admin_stats_msg(message: types.Message):
         await message.answer("❌ Siz admin emassiz!")
         return
     
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT COUNT(*) FROM subscriptions") as cursor:
-            total_users = (await cursor.fetchone())[0]
-        async with db.execute("SELECT COUNT(*) FROM user_settings WHERE is_running = 1") as cursor:
-            active_bots = (await cursor.fetchone())[0]
+    total_users = stats.subscriptions
+    active_bots = len(stats.running)
     
     text = (
         f"📈 **Tizim Statistikasi**\n\n"
@@ -1787,19 +3870,108 @@ async def admin_users_list_msg(message: types.Message):
         await message.answer("❌ Siz admin emassiz!")
         return
     
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT user_id, expiry_date FROM subscriptions") as cursor:
-            subs = await cursor.fetchall()
+    text, kb = await render_users_page("all", "")
+    await message.answer(text, reply_markup=kb, parse_mode="Markdown")
+
+@dp.callback_query(F.data.startswith("adm_u:"))
+async def admin_users_page(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("❌ Siz admin emassiz!", show_alert=True)
+        return
     
-    text = "👥 **Foydalanuvchilar:**\n\n"
-    if not subs:
-        text += "Hozircha foydalanuvchilar yo'q."
+    _, flt, cursor = callback.data.split(":", 2)
+    text, kb = await render_users_page(flt, cursor)
+    try:
+        await callback.message.edit_text(text, reply_markup=kb, parse_mode="Markdown")
+    except Exception as e:
+        # "message is not modified" - xuddi shu sahifa qayta bosildi
+        logging.debug(f"Users page not edited: {e}")
+    await callback.answer()
+
+ADMIN_USERS_PAGE = 20
+
+def md_escape(text):
+    for ch in ("_", "*", "`", "["):
+        text = text.replace(ch, "\\" + ch)
+    return text
+
+async def fetch_users_page(flt, cursor):
+    """Keyset sahifalash: (qatorlar, keyingi sahifa kursori yoki None).
+    all / p=<plan> - user_id bo'yicha; active / expired - (expiry_ts, user_id) bo'yicha indeksdan o'qiladi."""
+    now = int(time.time())
+    sql = """
+        SELECT s.user_id, s.expiry_ts, s.plan_type, u.full_name, u.username
+        FROM subscriptions s LEFT JOIN users u ON u.user_id = s.user_id
+    """
+    if flt in ("active", "expired"):
+        ts, uid = (int(x) for x in cursor.split(".")) if cursor else (None, None)
+        # Kursor bo'lsa faqat u bo'yicha qidiriladi: indeksdan kursordan boshlab o'qiladi
+        if flt == "active":
+            if cursor:
+                sql += "WHERE (s.expiry_ts, s.user_id) > (?, ?)"
+                params = [ts, uid]
+            else:
+                sql += "WHERE s.expiry_ts > ?"
+                params = [now]
+            sql += " ORDER BY s.expiry_ts, s.user_id"
+        else:
+            # Tugaganlar: eng yaqinda tugaganlari birinchi
+            if cursor:
+                sql += "WHERE (s.expiry_ts, s.user_id) < (?, ?)"
+                params = [ts, uid]
+            else:
+                sql += "WHERE s.expiry_ts <= ?"
+                params = [now]
+            sql += " ORDER BY s.expiry_ts DESC, s.user_id DESC"
     else:
-        for uid, expiry in subs[:30]:
-            status = "🟢" if datetime.strptime(expiry, "%Y-%m-%d %H:%M:%S") > datetime.now() else "🔴"
-            text += f"{status} `{uid}` | {expiry.split()[0]}\n"
-    
-    await message.answer(text, parse_mode="Markdown")
+        last_uid = int(cursor) if cursor else 0
+        if flt.startswith("p="):
+            sql += "WHERE s.plan_type = ? AND s.user_id > ?"
+            params = [flt[2:], last_uid]
+        else:
+            sql += "WHERE s.user_id > ?"
+            params = [last_uid]
+        sql += " ORDER BY s.user_id"
+    sql += " LIMIT ?"
+    params.append(ADMIN_USERS_PAGE + 1)
+    
+    rows = await database.fetchall(sql, params)
+    if len(rows) <= ADMIN_USERS_PAGE:
+        return rows, None
+    rows = rows[:ADMIN_USERS_PAGE]
+    last = rows[-1]
+    next_cursor = f"{last[1]}.{last[0]}" if flt in ("active", "expired") else str(last[0])
+    return rows, next_cursor
+
+async def render_users_page(flt, cursor):
+    rows, next_cursor = await fetch_users_page(flt, cursor)
+    now = time.time()
+    
+    filter_names = {"all": "Hammasi", "active": "Faol", "expired": "Tugagan"}
+    title = filter_names.get(flt, flt[2:].upper() if flt.startswith("p=") else flt)
+    text = f"👥 **Foydalanuvchilar** ({title})\n\n"
+    if not rows:
+        text += "Foydalanuvchilar topilmadi."
+    for uid, expiry_ts, plan_type, full_name, username in rows:
+        status = "🟢" if expiry_ts and expiry_ts > now else "🔴"
+        expiry = datetime.fromtimestamp(expiry_ts).strftime("%Y-%m-%d") if expiry_ts else "-"
+        name = md_escape(full_name) if full_name else "Noma'lum"
+        text += f"{status} `{uid}` | {name} | {plan_type or '-'} | {expiry}\n"
+    
+    def mark(key, label):
+        return f"• {label}" if key == flt else label
+    kb = [
+        [InlineKeyboardButton(text=mark(key, label), callback_data=f"adm_u:{key}:") for key, label in filter_names.items()],
+        [InlineKeyboardButton(text=mark(f"p={plan}", plan.upper()), callback_data=f"adm_u:p={plan}:") for plan, days, price in await get_prices()],
+    ]
+    nav = []
+    if cursor:
+        nav.append(InlineKeyboardButton(text="⏮ Boshiga", callback_data=f"adm_u:{flt}:"))
+    if next_cursor:
+        nav.append(InlineKeyboardButton(text="▶️ Keyingi", callback_data=f"adm_u:{flt}:{next_cursor}"))
+    if nav:
+        kb.append(nav)
+    return text, InlineKeyboardMarkup(inline_keyboard=kb)
 
 @dp.message(F.text == "🔍 Qidirish")
 async def admin_search_msg(message: types.Message, state: FSMContext):
@@ -1823,9 +3995,7 @@ async def admin_payment_info_msg(message: types.Message, state: FSMContext):
         await message.answer("❌ Siz admin emassiz!")
         return
     
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT card_number, card_holder, amount FROM payment_info ORDER BY created_at DESC LIMIT 1") as cursor:
-            row = await cursor.fetchone()
+    row = await database.fetchone("SELECT card_number, card_holder, amount FROM payment_info ORDER BY created_at DESC LIMIT 1")
     
     if row:
         card_number, card_holder, amount = row
@@ -1849,9 +4019,7 @@ async def admin_pricing_msg(message: types.Message):
         await message.answer("❌ Siz admin emassiz!")
         return
     
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT plan_type, duration_days, price FROM pricing ORDER BY duration_days") as cursor:
-            prices = await cursor.fetchall()
+    prices = await get_prices()
     
     text = "💰 **Obuna Narxlari**\n\n"
     for plan, days, price in prices:
@@ -1900,28 +4068,26 @@ async def process_add_admin(message: types.Message, state: FSMContext):
         return
     
     # Tekshirish - allaqachon admin bo'lsa
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT admin_id FROM admins WHERE admin_id = ?", (new_admin_id,)) as cursor:
-            existing = await cursor.fetchone()
-        
-        if existing:
-            await message.answer(f"❌ Foydalanuvchi `{new_admin_id}` allaqachon admin!", parse_mode="Markdown")
-            await state.clear()
-            return
-        
-        # Yangi admin qo'shish
-        try:
-            await db.execute("""
-                INSERT INTO admins (admin_id, added_by, created_at)
-                VALUES (?, ?, ?)
-            """, (new_admin_id, message.from_user.id, datetime.now().isoformat()))
-            await db.commit()
-            logging.info(f"New admin added: {new_admin_id} by {message.from_user.id}")
-        except Exception as e:
-            logging.error(f"Error adding admin: {e}")
-            await message.answer(f"❌ Xatolik: {e}")
-            await state.clear()
-            return
+    existing = await database.fetchone("SELECT admin_id FROM admins WHERE admin_id = ?", (new_admin_id,))
+    
+    if existing:
+        await message.answer(f"❌ Foydalanuvchi `{new_admin_id}` allaqachon admin!", parse_mode="Markdown")
+        await state.clear()
+        return
+    
+    # Yangi admin qo'shish
+    try:
+        await database.execute("""
+            INSERT INTO admins (admin_id, added_by, created_at)
+            VALUES (?, ?, ?)
+        """, (new_admin_id, message.from_user.id, datetime.now().isoformat()))
+        access_cache.set_admin(new_admin_id, True)
+        logging.info(f"New admin added: {new_admin_id} by {message.from_user.id}")
+    except Exception as e:
+        logging.error(f"Error adding admin: {e}")
+        await message.answer(f"❌ Xatolik: {e}")
+        await state.clear()
+        return
     
     await message.answer(f"✅ Foydalanuvchi `{new_admin_id}` admin qilib belgilandi!", parse_mode="Markdown")
     
@@ -1942,9 +4108,7 @@ async def list_admins_msg(message: types.Message):
         await message.answer("❌ Siz admin emassiz!")
         return
     
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT admin_id, created_at FROM admins ORDER BY created_at DESC") as cursor:
-            admins = await cursor.fetchall()
+    admins = await database.fetchall("SELECT admin_id, created_at FROM admins ORDER BY created_at DESC")
     
     text = "👥 **Admin Ro'yxati**\n\n"
     text += f"👑 Asosiy Admin: `{ADMIN_ID}`\n\n"
@@ -1988,11 +4152,8 @@ async def admin_stats(callback: types.CallbackQuery):
         await callback.answer("❌ Siz admin emassiz!", show_alert=True)
         return
     
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT COUNT(*) FROM subscriptions") as cursor:
-            total_users = (await cursor.fetchone())[0]
-        async with db.execute("SELECT COUNT(*) FROM user_settings WHERE is_running = 1") as cursor:
-            active_bots = (await cursor.fetchone())[0]
+    total_users = stats.subscriptions
+    active_bots = len(stats.running)
     
     text = (
         f"📈 **Tizim Statistikasi**\n\n"
@@ -2014,9 +4175,7 @@ async def process_admin_search(message: types.Message, state: FSMContext):
         await message.answer("❌ Noto'g'ri format!")
         return
     
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT expiry_date FROM subscriptions WHERE user_id = ?", (search_id,)) as cursor:
-            row = await cursor.fetchone()
+    row = await database.fetchone("SELECT expiry_date FROM subscriptions WHERE user_id = ?", (search_id,))
     
     if row:
         expiry = row[0]
@@ -2103,9 +4262,7 @@ async def user_extend_days(callback: types.CallbackQuery, state: FSMContext):
     await state.update_data(plan_type=plan_type, plan_name=plan_name, days=days, amount=amount)
     
     # Admin panel'dan to'lov ma'lumotlarini olish
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT card_number, card_holder, amount FROM payment_info ORDER BY created_at DESC LIMIT 1") as cursor:
-            payment_row = await cursor.fetchone()
+    payment_row = await database.fetchone("SELECT card_number, card_holder, amount FROM payment_info ORDER BY created_at DESC LIMIT 1")
     
     if payment_row:
         card_number, card_holder, payment_amount = payment_row
@@ -2152,9 +4309,11 @@ async def admin_remove_sub(callback: types.CallbackQuery):
         return
     
     user_id = int(callback.data.split("_")[-1])
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM subscriptions WHERE user_id = ?", (user_id,))
-        await db.commit()
+    cursor = await database.execute("DELETE FROM subscriptions WHERE user_id = ?", (user_id,))
+    access_cache.remove_subscription(user_id)
+    if cursor.rowcount:
+        stats.subscriptions -= 1
+    await stop_sender(user_id, "❌ Obunangiz bekor qilindi! Xizmat to'xtatildi.")
     
     await callback.message.answer(f"✅ Obuna o'chirildi!", parse_mode="Markdown")
     await callback.answer()
@@ -2192,9 +4351,7 @@ async def admin_pricing(callback: types.CallbackQuery):
         await callback.answer("❌ Siz admin emassiz!", show_alert=True)
         return
     
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT plan_type, duration_days, price FROM pricing ORDER BY duration_days") as cursor:
-            prices = await cursor.fetchall()
+    prices = await get_prices()
     
     text = "💰 **Obuna Narxlari**\n\n"
     for plan, days, price in prices:
@@ -2235,9 +4392,8 @@ async def process_price_update(message: types.Message, state: FSMContext):
         data = await state.get_data()
         plan = data.get('edit_plan')
         
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("UPDATE pricing SET price = ? WHERE plan_type = ?", (new_price, plan))
-            await db.commit()
+        await database.execute("UPDATE pricing SET price = ? WHERE plan_type = ?", (new_price, plan))
+        invalidate_pricing()
         
         await message.answer(f"✅ {plan.upper()} reja narxi **{new_price:,} so'm** qilib o'zgartirildi!", parse_mode="Markdown")
         await state.clear()
@@ -2251,9 +4407,7 @@ async def admin_payment_info(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer("❌ Siz admin emassiz!", show_alert=True)
         return
     
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT card_number, card_holder, amount FROM payment_info ORDER BY created_at DESC LIMIT 1") as cursor:
-            row = await cursor.fetchone()
+    row = await database.fetchone("SELECT card_number, card_holder, amount FROM payment_info ORDER BY created_at DESC LIMIT 1")
     
     if row:
         card_number, card_holder, amount = row
@@ -2312,13 +4466,13 @@ async def process_payment_info(message: types.Message, state: FSMContext):
         card_holder = lines[1].strip()
         amount = int(lines[2].strip())
         
-        async with aiosqlite.connect(DB_PATH) as db:
+        async def replace_payment_info(db):
             await db.execute("DELETE FROM payment_info")
             await db.execute(
                 "INSERT INTO payment_info (card_number, card_holder, amount, created_at) VALUES (?, ?, ?, ?)",
                 (card_number, card_holder, amount, datetime.now().isoformat())
             )
-            await db.commit()
+        await database.transaction(replace_payment_info)
         
         await message.answer(
             f"✅ To'lov ma'lumotlari saqlandi!\n\n"
@@ -2331,12 +4485,69 @@ async def process_payment_info(message: types.Message, state: FSMContext):
     except ValueError:
         await message.answer("❌ Summa noto'g'ri! Faqat raqam kiriting.")
 
+class StartupWarmup:
+    """Ishga tushishda sessiyalarni cheklangan parallellik va tarqoq oraliqlar bilan ulash"""
+
+    def __init__(self):
+        self.total = 0
+        self.connected = 0
+        self.failed = 0
+        self._started_at = None
+
+    @property
+    def done(self):
+        return self.connected + self.failed
+
+    async def _connect(self, semaphore, user_id, key):
+        async with semaphore:
+            try:
+                client = await get_user_client(user_id, session_name=None if key == f"sess_{user_id}" else key)
+            except Exception as e:
+                logging.error(f"Warm-up failed for {key}: {e}")
+                client = None
+        if client is None:
+            self.failed += 1
+        else:
+            self.connected += 1
+        if self.done == self.total or self.done % WARMUP_REPORT_EVERY == 0:
+            logging.info(
+                f"Warm-up progress: {self.done}/{self.total} sessions "
+                f"({self.failed} failed, {time.monotonic() - self._started_at:.0f}s)"
+            )
+
+    async def run(self, keys):
+        """keys: [(user_id, session_key)] - birinchi tsikl vaqti bo'yicha tartiblangan"""
+        self.total = len(keys)
+        self._started_at = time.monotonic()
+        if not keys:
+            return
+        logging.info(f"Warming up {self.total} sessions ({WARMUP_CONCURRENCY} at a time)")
+        semaphore = asyncio.Semaphore(WARMUP_CONCURRENCY)
+        tasks = []
+        for user_id, key in keys:
+            tasks.append(asyncio.create_task(self._connect(semaphore, user_id, key)))
+            # Handshake'lar bir lahzaga to'planmasligi uchun har bir ulanish tasodifiy oraliq bilan boshlanadi
+            await asyncio.sleep(WARMUP_SPACING_SECONDS * random.uniform(0.5, 1.5))
+        await asyncio.gather(*tasks)
+
+startup_warmup = StartupWarmup()
+
 async def resume_senders():
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT user_id, interval, ad_text, image_path, video_path, voice_path FROM user_settings WHERE is_running = 1") as cursor:
-            running_users = await cursor.fetchall()
-    
-    for user_id, interval, ad_text, img, vid, voice in running_users:
+    """Ishlab turgan senderlarni tiklash. Oldindan ulanadigan (user_id, sessiya) ro'yxatini qaytaradi."""
+    running_users = await database.fetchall("SELECT user_id, interval, ad_text, image_path, video_path, voice_path FROM user_settings WHERE is_running = 1")
+
+    # Obunasi yo'q yoki muddati noma'lum userlar tiklanmaydi - sweeper faqat expiry_ts'i borlarni ko'radi
+    active_users = []
+    for row in running_users:
+        if await check_subscription(row[0]):
+            active_users.append(row)
+        else:
+            await set_sender_running(row[0], False)
+            logging.info(f"Not resuming sender for user {row[0]}: no active subscription")
+    running_users = active_users
+
+    warmup_keys = []
+    for i, (user_id, interval, ad_text, img, vid, voice) in enumerate(running_users):
         users_data[user_id] = {
             'is_running': True,
             'interval': interval,
@@ -2345,15 +4556,49 @@ async def resume_senders():
             'video_path': vid,
             'voice_path': voice
         }
-        asyncio.create_task(start_sender(user_id))
-        logging.info(f"Resumed sender for user {user_id}")
+        await compile_ad(user_id, ad_text, img, vid, voice)
+        # Birinchi tsikllar STARTUP_RAMP_SECONDS oynasiga teng tarqatiladi (interval'dan kech emas)
+        delay = min(STARTUP_RAMP_SECONDS * i / len(running_users), interval or STARTUP_RAMP_SECONDS)
+        profiles = await database.fetchall("SELECT session_name FROM profiles WHERE user_id = ? AND is_active = 1", (user_id,))
+        keys = [f"sess_{user_id}"] + [session_name for (session_name,) in profiles]
+        # Pulga sig'adigan akkauntlarni warm-up ulaydi, qolganlari tsikl oldidan odatdagidek ulanadi
+        prewarm = len(warmup_keys) + len(keys) > CLIENT_POOL_SIZE
+        if not prewarm:
+            warmup_keys.extend((user_id, key) for key in keys)
+        scheduler.schedule(user_id, delay=delay, prewarm=prewarm)
+        logging.info(f"Resumed sender for user {user_id}, first cycle in {delay:.0f}s")
+    return warmup_keys
 
 # --- Main ---
 async def main():
+    await database.connect()
     await init_db()
+    await session_store.load_keys()
+    await session_store.import_legacy()
+    await access_cache.load()
+    await stats.reconcile()
     print("Bot ishga tushdi...")
-    asyncio.create_task(resume_senders())
-    await dp.start_polling(bot)
+    await target_quarantine.load()
+    scheduler.start()
+    background_tasks = [
+        asyncio.create_task(delivery_log.run()),
+        asyncio.create_task(delivery_log_retention()),
+        asyncio.create_task(stats.run()),
+    ]
+    background_tasks.append(asyncio.create_task(startup_warmup.run(await resume_senders())))
+    background_tasks.append(asyncio.create_task(subscription_sweeper.run()))
+    try:
+        await dp.start_polling(bot)
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        # Tsikllar finally'da outbox'ni yozadi - baza yopilishidan oldin tugashi kerak
+        await scheduler.stop()
+        await delivery_log.flush()
+        await fsm_storage.close()
+        await client_pool.close()
+        await session_store.close()
+        await database.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -2389,13 +4634,9 @@ async def show_stats(callback: types.CallbackQuery):
     interval = users_data.get(user_id, {}).get('interval', DEFAULT_AD_DELAY)
     ad_text = users_data.get(user_id, {}).get('ad_text', '')
     
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT COUNT(*) FROM subscriptions") as cursor:
-            total_users_count = (await cursor.fetchone())[0]
-        async with db.execute("SELECT COUNT(*) FROM profiles WHERE user_id = ?", (user_id,)) as cursor:
-            profiles_count = (await cursor.fetchone())[0]
-        async with db.execute("SELECT COUNT(*) FROM groups WHERE user_id = ?", (user_id,)) as cursor:
-            groups_count = (await cursor.fetchone())[0]
+    total_users_count = stats.subscriptions
+    profiles_count = stats.profiles.get(user_id, 0)
+    groups_count = stats.groups.get(user_id, 0)
 
     text = (
         f"📊 **Bot Statistikasi**\n\n"
@@ -2425,9 +4666,7 @@ async def list_admins(callback: types.CallbackQuery):
         await callback.answer("❌ Siz admin emassiz!", show_alert=True)
         return
     
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT admin_id, created_at FROM admins ORDER BY created_at DESC") as cursor:
-            admins = await cursor.fetchall()
+    admins = await database.fetchall("SELECT admin_id, created_at FROM admins ORDER BY created_at DESC")
     
     text = "👥 **Admin Ro'yxati**\n\n"
     text += f"👑 Asosiy Admin: `{ADMIN_ID}`\n\n"
@@ -2483,26 +4722,23 @@ async def process_remove_admin_callback(callback: types.CallbackQuery):
             await callback.answer("❌ O'zingizni o'chira olmaysiz!", show_alert=True)
             return
         
-        async with aiosqlite.connect(DB_PATH) as db:
-            # Avval admin mavjudligini tekshirish
-            async with db.execute("SELECT admin_id FROM admins WHERE admin_id = ?", (remove_admin_id,)) as cursor:
-                exists = await cursor.fetchone()
-            
-            if not exists:
-                await callback.answer("❌ Admin topilmadi!", show_alert=True)
-                return
-            
-            # Oxirgi adminni o'chirishni tekshirish (asosiy admindan tashqari)
-            async with db.execute("SELECT COUNT(*) FROM admins") as cursor:
-                admin_count = (await cursor.fetchone())[0]
-            
-            if admin_count <= 1:
-                await callback.answer("❌ Oxirgi adminni o'chira olmaysiz!", show_alert=True)
-                return
-            
-            # Adminni o'chirish
-            await db.execute("DELETE FROM admins WHERE admin_id = ?", (remove_admin_id,))
-            await db.commit()
+        # Avval admin mavjudligini tekshirish
+        exists = await database.fetchone("SELECT admin_id FROM admins WHERE admin_id = ?", (remove_admin_id,))
+        
+        if not exists:
+            await callback.answer("❌ Admin topilmadi!", show_alert=True)
+            return
+        
+        # Oxirgi adminni o'chirishni tekshirish (asosiy admindan tashqari)
+        admin_count = (await database.fetchone("SELECT COUNT(*) FROM admins"))[0]
+        
+        if admin_count <= 1:
+            await callback.answer("❌ Oxirgi adminni o'chira olmaysiz!", show_alert=True)
+            return
+        
+        # Adminni o'chirish
+        await database.execute("DELETE FROM admins WHERE admin_id = ?", (remove_admin_id,))
+        access_cache.set_admin(remove_admin_id, False)
         
         await callback.answer("✅ Admin o'chirildi!", show_alert=True)
         await callback.message.edit_text(
@@ -2547,28 +4783,25 @@ async def process_remove_admin(message: types.Message, state: FSMContext):
             await state.clear()
             return
         
-        async with aiosqlite.connect(DB_PATH) as db:
-            # Avval admin mavjudligini tekshirish
-            async with db.execute("SELECT admin_id FROM admins WHERE admin_id = ?", (remove_admin_id,)) as cursor:
-                exists = await cursor.fetchone()
-            
-            if not exists:
-                await message.answer(f"❌ Admin `{remove_admin_id}` topilmadi!", parse_mode="Markdown")
-                await state.clear()
-                return
-            
-            # Oxirgi adminni o'chirishni tekshirish (asosiy admindan tashqari)
-            async with db.execute("SELECT COUNT(*) FROM admins") as cursor:
-                admin_count = (await cursor.fetchone())[0]
-            
-            if admin_count <= 1:
-                await message.answer("❌ Oxirgi adminni o'chira olmaysiz!", parse_mode="Markdown")
-                await state.clear()
-                return
-            
-            # Adminni o'chirish
-            await db.execute("DELETE FROM admins WHERE admin_id = ?", (remove_admin_id,))
-            await db.commit()
+        # Avval admin mavjudligini tekshirish
+        exists = await database.fetchone("SELECT admin_id FROM admins WHERE admin_id = ?", (remove_admin_id,))
+        
+        if not exists:
+            await message.answer(f"❌ Admin `{remove_admin_id}` topilmadi!", parse_mode="Markdown")
+            await state.clear()
+            return
+        
+        # Oxirgi adminni o'chirishni tekshirish (asosiy admindan tashqari)
+        admin_count = (await database.fetchone("SELECT COUNT(*) FROM admins"))[0]
+        
+        if admin_count <= 1:
+            await message.answer("❌ Oxirgi adminni o'chira olmaysiz!", parse_mode="Markdown")
+            await state.clear()
+            return
+        
+        # Adminni o'chirish
+        await database.execute("DELETE FROM admins WHERE admin_id = ?", (remove_admin_id,))
+        access_cache.set_admin(remove_admin_id, False)
         
         await message.answer(f"✅ Admin `{remove_admin_id}` o'chirildi!", parse_mode="Markdown")
         await state.clear()
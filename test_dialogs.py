@@ -8,10 +8,29 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+# Sessiyalar endi bazada (tg_sessions/tg_entities); sessions/*.session fayllari
+# bot birinchi ishga tushganda import qilinib sessions/legacy/ ga ko'chiriladi
+from main import database, session_store
+
+SESSION_KEY = 'sess_2114098498'
+
 async def main():
-    client = TelegramClient('sessions/sess_2114098498', int(os.getenv('API_ID')), os.getenv('API_HASH'))
-    await client.connect()
-    
+    await database.connect()
+    try:
+        await session_store.load_keys()
+        if not session_store.has(SESSION_KEY):
+            print("Session not found in the store (start the bot once to import sessions/*.session).")
+            return
+        client = TelegramClient(await session_store.open(SESSION_KEY), int(os.getenv('API_ID')), os.getenv('API_HASH'))
+        await client.connect()
+        try:
+            await show_filters(client)
+        finally:
+            await client.disconnect()
+    finally:
+        await database.close()
+
+async def show_filters(client):
     if not await client.is_user_authorized():
         print("Not authorized.")
         return